@@ -0,0 +1,75 @@
+# async_peer.py
+import asyncio
+import socket
+import threading
+import config
+from config import PORT
+from logger import log
+
+class LSNPProtocol(asyncio.DatagramProtocol):
+    """Hands every received datagram to the regular message handler."""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def datagram_received(self, data, addr):
+        if config.VERBOSE:
+            log(f"RECV < {addr}\n{data.decode('utf-8', errors='ignore')}")
+        try:
+            self.handler(data, addr)
+        except Exception as e:
+            log(f"Handler error for datagram from {addr}: {e}")
+
+    def error_received(self, exc):
+        log(f"UDP receive error: {exc}")
+
+class AsyncPeer:
+    """Runs receive, timers and file transfers as coroutines on one event loop.
+
+    handler is the same callable passed to network.listen; schedulers are
+    objects with poll() and a waker hook (timers.TimerScheduler,
+    filetransfer.TransferScheduler), each driven on the loop. Handlers run
+    inline; slow file work (hashing, finishing files) goes to
+    filetransfer.file_io, as it does in threads mode.
+    """
+
+    def __init__(self, handler, schedulers=()):
+        self.handler = handler
+        self.schedulers = list(schedulers)
+        self.loop = None
+        self.transport = None
+        self._ready = threading.Event()
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(("", PORT))
+            self.transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: LSNPProtocol(self.handler), sock=s)
+            for scheduler in self.schedulers:
+                self.loop.create_task(self._drive(scheduler))
+        finally:
+            self._ready.set()  # Never leave start() waiting, even if bind failed
+        await asyncio.Event().wait()  # Run until the process exits
+
+    def start(self):
+        """Start the event loop on a background thread, leaving the caller free for the CLI."""
+        threading.Thread(target=asyncio.run, args=(self._main(),), name="lsnp-asyncio", daemon=True).start()
+        self._ready.wait()
+
+    async def _drive(self, scheduler):
+        """Run a scheduler on the loop instead of its own thread."""
+        wake = asyncio.Event()
+        scheduler.waker = lambda: self.loop.call_soon_threadsafe(wake.set)
+        while True:
+            delay = scheduler.poll()
+            if delay == 0:
+                await asyncio.sleep(0)  # Let datagrams in between chunks
+                continue
+            try:
+                await asyncio.wait_for(wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
@@ -11,4 +11,52 @@ STATUS = "Exploring LSNP!"
 TTL_DEFAULT = 3600
 
 # Toggle verbose mode (can change via CLI)
-VERBOSE = False
\ No newline at end of file
+VERBOSE = False
+
+# Optional protocol features we advertise in PROFILE (CAPABILITIES field)
+CAPABILITIES = ["BINARY_CHUNK", "FILE_ACCEPT", "FILE_ACK", "FILE_NACK", "COMPRESSION", "BUNDLE"]
+
+FILE_CHUNK_SIZE = 45000       # raw bytes per FILE_CHUNK (~60KB once base64 encoded)
+FILE_COMPRESSION = "zlib"     # "zlib", "lzma" or "none"; used only with peers advertising COMPRESSION
+FILE_BANDWIDTH = 40_000_000   # bytes/s shared by all outgoing transfers; keep below link speed for chat headroom
+
+# Retention: capacity limits plus age-based expiry, applied by a background sweep
+MAX_POSTS = 5000              # posts also expire after their own TTL
+MAX_DMS = 5000
+MAX_LIKES = 10000             # LIKE/UNLIKE history; per-post counts are kept with the post
+MAX_PEERS = 1000
+DM_RETENTION = 86400          # seconds a received DM is kept
+PEER_STALE_AFTER = 150        # seconds without any datagram before a peer is shown as stale
+PEER_TIMEOUT = 300            # seconds without any datagram before a peer is forgotten
+
+# Persistence: keep state in SQLite across restarts (None keeps everything in memory only)
+PERSIST_PATH = None           # e.g. "lsnp_state.db"
+PERSIST_FLUSH_INTERVAL = 2    # seconds between batched writes
+
+# Background intervals (seconds)
+PRESENCE_INTERVAL = 10        # heartbeat interval on a small LAN; grows with the peer count
+PRESENCE_PEERS_PER_INTERVAL = 20  # peers we can see before heartbeats start backing off
+PRESENCE_MAX_INTERVAL = 90    # heartbeat ceiling; keep well under PEER_TIMEOUT
+PROFILE_REFRESH_INTERVAL = 300  # full PROFILE broadcast for peers that never request it
+STORAGE_SWEEP_INTERVAL = 30   # retention sweep of posts, DMs, likes and peers
+
+# "threads" runs one thread per loop; "asyncio" runs them on one event loop
+RUNTIME = "threads"
+
+# Receive pipeline: the socket thread only queues datagrams, workers run handlers
+RECV_WORKERS = 4              # 0 handles messages inline on the receive thread
+RECV_QUEUE_SIZE = 2048        # total datagrams buffered across all workers
+OVERLOAD_POLICY = "drop_by_type"  # or "drop_oldest"
+SHED_TYPES = ("PING", "PROFILE")  # dropped first (in this order) when queues are full
+
+# Coalescing: small messages to BUNDLE-capable peers share one datagram
+BUNDLE_WINDOW = 0.02          # seconds a small message may wait for company; 0 sends everything at once
+BUNDLE_MAX_BYTES = 1400       # frame size limit; stays within one Ethernet frame so a bundle is never fragmented
+BUNDLE_TYPES = ("PING", "PROFILE", "LIKE", "FOLLOW", "UNFOLLOW", "POST")
+
+# Duplicate suppression by (sender, MESSAGE_ID)
+DEDUP_TTL = 300               # seconds an ID is remembered (at least)
+DEDUP_MAX_IDS = 50000         # IDs per generation; at most twice this are held
+
+# Validated TOKENs are remembered until they expire (up to this many)
+TOKEN_CACHE_SIZE = 4096
\ No newline at end of file
@@ -0,0 +1,53 @@
+# dispatch.py
+import time
+import threading
+import config
+
+handlers = {}  # {TYPE: handler(msg, sender_id)}
+
+def register(msg_type: str):
+    """Decorator that registers a handler for one message TYPE.
+
+    Modules (and plugins) register at import time; handle_message looks the
+    handler up after its pre-parse filter, so unregistered TYPEs are never parsed.
+    """
+    def decorator(fn):
+        handlers[msg_type] = fn
+        return fn
+    return decorator
+
+class SeenCache:
+    """Recently seen message IDs, kept in two rotating generations.
+
+    IDs go into the current set; when it reaches max_size entries or ttl
+    seconds of age it becomes the previous set and the old previous set is
+    dropped. An ID is therefore remembered for at least ttl seconds (unless
+    traffic fills a generation first), and memory never exceeds 2 * max_size IDs.
+    """
+
+    def __init__(self, ttl: float = None, max_size: int = None):
+        self.ttl = config.DEDUP_TTL if ttl is None else ttl
+        self.max_size = config.DEDUP_MAX_IDS if max_size is None else max_size
+        self.duplicates = 0
+        self._current = set()
+        self._previous = set()
+        self._rotated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, key) -> bool:
+        """Record key; True if it was already seen (the message is a duplicate)."""
+        with self._lock:
+            if key in self._current or key in self._previous:
+                self.duplicates += 1
+                return True
+            if len(self._current) >= self.max_size or time.monotonic() - self._rotated >= self.ttl:
+                self._previous = self._current
+                self._current = set()
+                self._rotated = time.monotonic()
+            self._current.add(key)
+            return False
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+seen_messages = SeenCache()
@@ -0,0 +1,1166 @@
+# filetransfer.py
+import os
+import re
+import json
+import time
+import random
+import base64
+import shutil
+import hashlib
+import zlib
+import lzma
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import config
+from config import USER_ID, TTL_DEFAULT, FILE_CHUNK_SIZE, BUFFER_SIZE
+from parser import build_message, MessageBuilder
+from network import send_to
+from logger import log, print_non_verbose
+from storage import peers, peer_state, incoming_files, outgoing_transfers, incoming_locks, transfers_lock, peer_supports
+from dispatch import register
+from timers import call_later
+
+RECEIVED_DIR = "received_files"
+OFFER_TIMEOUT = 300  # Seconds an unanswered offer is kept
+READAHEAD_CHUNKS = 4  # Chunks read ahead of the one being sent
+DEFAULT_PRIORITY = 1  # Scheduler weight; a priority-3 transfer gets 3x the bytes of a priority-1 one
+FILE_ACCEPT_TIMEOUT = 120  # Seconds the sender waits for FILE_ACCEPT/FILE_REJECT
+ACCEPT_POLL_INTERVAL = 0.1
+
+# Flow control for receivers that acknowledge chunks (FILE_ACK capability)
+ACK_EVERY = 8             # Receiver acks after this many new chunks
+ACK_TIMEOUT = 1.0         # Seconds with a full window and no ack before backing off
+MAX_ACK_TIMEOUTS = 10     # Ack timeouts in a row before the receiver is given up on
+INITIAL_RATE = 20.0       # Chunks per second
+MIN_RATE = 2.0
+MAX_RATE = 3000.0         # ~1 Gbit/s at 45 KB chunks
+INITIAL_WINDOW = 16       # Unacknowledged chunks allowed in flight
+MIN_WINDOW = 2 * ACK_EVERY  # Room for a full ack's worth of chunks even with some lost
+MAX_WINDOW = 512
+LEGACY_CHUNK_DELAY = 0.1  # Fixed pacing for receivers that never ack
+
+# Selective retransmission (FILE_NACK capability)
+STALL_TIMEOUT = 3.0       # Seconds without a new chunk before the receiver NACKs
+RESUME_TIMEOUT = 600      # Seconds an idle, partly received file is kept for resuming
+RESEND_LINGER = RESUME_TIMEOUT  # Seconds a sender keeps a finished transfer for NACKs; as long as the receiver can resume
+MAX_NACK_RANGES = 64      # Ranges per FILE_NACK, keeps the datagram small
+
+# Chunk compression (COMPRESSION capability)
+COMPRESS_SAMPLE_CHUNKS = 4  # Chunks tried before deciding whether a file compresses
+COMPRESS_MIN_RATIO = 0.9    # Give up if the sample doesn't shrink below this fraction
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1             # Higher presets cost far more CPU per chunk for little gain
+
+HASH_INDEX_FILE = ".hashindex.json"
+HASH_READ_SIZE = 1 << 20  # Bytes per read while hashing
+FILE_IO_WORKERS = 2       # Threads for hashing and finishing files
+
+# Hashing whole files and moving finished ones into place can take seconds. It
+# runs here, never on a handler worker, the transfer scheduler or the event loop.
+file_io = ThreadPoolExecutor(max_workers=FILE_IO_WORKERS, thread_name_prefix="lsnp-file-io")
+
+def _logged(fn, *args):
+    try:
+        return fn(*args)
+    except Exception as e:
+        log(f"{fn.__name__} failed: {e}")
+        raise
+
+def in_background(fn, *args):
+    """Run fn(*args) on the file I/O pool; errors are logged. Returns its Future."""
+    return file_io.submit(_logged, fn, *args)
+
+_digest_cache = {}  # {(abspath, size, mtime_ns): sha256 hex} for files we've sent
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file, read in bounded pieces and cached until the file changes."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    digest = _digest_cache.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            while piece := f.read(HASH_READ_SIZE):
+                h.update(piece)
+        digest = _digest_cache[key] = h.hexdigest()
+    return digest
+
+class ContentIndex:
+    """Digest index of received_files/, so content we already hold isn't transferred again.
+
+    Stored next to the files as {filename: [size, mtime_ns, digest]}; on load
+    only new or changed files are rehashed.
+    """
+
+    def __init__(self, directory: str = RECEIVED_DIR):
+        self.directory = directory
+        self._entries = None  # Loaded on first use
+        self._by_digest = {}
+        self._lock = threading.Lock()
+
+    def _index_path(self):
+        return os.path.join(self.directory, HASH_INDEX_FILE)
+
+    def _load(self):
+        try:
+            with open(self._index_path()) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+        entries = {}
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.startswith(".") or not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                entry = saved.get(name)
+                if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                    entry = [st.st_size, st.st_mtime_ns, file_digest(path)]
+                entries[name] = entry
+        self._entries = entries
+        self._by_digest = {entry[2]: name for name, entry in entries.items()}
+        self._save()
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._index_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self._index_path())
+
+    def lookup(self, digest: str):
+        """Path of a received file with this digest, or None."""
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            name = self._by_digest.get(digest)
+            if name is None:
+                return None
+            path = os.path.join(self.directory, name)
+            st = os.stat(path) if os.path.isfile(path) else None
+            if st is None or [st.st_size, st.st_mtime_ns] != self._entries[name][:2]:
+                # Deleted or edited since it was indexed
+                del self._by_digest[digest]
+                self._entries.pop(name, None)
+                return None
+            return path
+
+    def add(self, path: str) -> str:
+        """Index a newly received file and return its digest."""
+        digest = file_digest(path)
+        st = os.stat(path)
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            name = os.path.basename(path)
+            self._entries[name] = [st.st_size, st.st_mtime_ns, digest]
+            self._by_digest[digest] = name
+            self._save()
+        return digest
+
+content_index = ContentIndex()
+
+_FILEID_RE = re.compile(r"[0-9a-fA-F]{1,64}")
+
+def valid_fileid(fileid) -> bool:
+    """FILEIDs are hex (see prepare_transfer); anything else could name a path."""
+    return bool(fileid) and _FILEID_RE.fullmatch(fileid) is not None
+
+def safe_filename(filename, fileid: str) -> str:
+    """The offered name reduced to a plain file name under received_files/."""
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    return name if name not in ("", ".", "..") else fileid
+
+def unique_path(filename: str) -> str:
+    """A path under received_files/ for filename that doesn't exist yet."""
+    path = os.path.join(RECEIVED_DIR, filename)
+    counter = 1
+    base_name, ext = os.path.splitext(filename)
+    while os.path.exists(path):
+        path = os.path.join(RECEIVED_DIR, f"{base_name}_{counter}{ext}")
+        counter += 1
+    return path
+
+class IncomingFile:
+    """Receiver-side state for one offered file.
+
+    Chunks are decoded as they arrive and written at their offset in a
+    preallocated .part file, so only a bitmap of received chunks stays in
+    memory. finish() renames the .part file into place atomically.
+    """
+
+    def __init__(self, fileid, sender, filename, filesize, filetype, description, digest=None):
+        self.fileid = fileid
+        self.sender = sender
+        # Never let a peer pick a path outside received_files/
+        self.filename = safe_filename(filename, fileid)
+        self.filesize = int(filesize or 0)
+        self.filetype = filetype
+        self.description = description
+        self.digest = digest  # SHA-256 from the offer, if the sender sent one
+        self.timestamp = time.time()
+        self.accepted = False
+        self.total_chunks = None
+        self.received_count = 0
+        self.highest_chunk = -1
+        self.chunk_size = None  # Learned from the first chunk that reveals it
+        self.last_nack = 0.0
+        self.bitmap = None  # bytearray, one bit per chunk
+        self.part_path = os.path.join(RECEIVED_DIR, f".{fileid}.part")
+        self.discarded = False  # Set by discard(); no chunk may reopen the .part file after it
+        self._fd = None
+        self._lock = threading.Lock()  # Per-file, so one transfer never blocks another
+
+    def accept(self):
+        self.accepted = True
+        self.timestamp = time.time()
+
+    def _open(self):
+        os.makedirs(RECEIVED_DIR, exist_ok=True)
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        os.ftruncate(fd, self.filesize)  # Preallocate; chunks land at their offsets
+        self._fd = fd
+
+    def _pwrite(self, data, offset):
+        if hasattr(os, "pwrite"):
+            os.pwrite(self._fd, data, offset)
+        else:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            os.write(self._fd, data)
+
+    def has_chunk(self, idx: int) -> bool:
+        return bool(self.bitmap[idx >> 3] & (1 << (idx & 7)))
+
+    def _check_chunk(self, idx: int, total: int, offset: int, length: int):
+        """Why a chunk doesn't fit this file, or None. Caller holds _lock."""
+        if not 0 < total <= max(1, self.filesize):
+            return f"bad chunk count {total}"
+        if not 0 <= idx < total:
+            return f"chunk index {idx} out of range"
+        if offset < 0 or offset + length > self.filesize:
+            return f"chunk at {offset}+{length} is outside the {self.filesize}-byte file"
+        chunk_size = self.chunk_size
+        if idx < total - 1:
+            # Every chunk but the last is exactly chunk_size bytes at idx * chunk_size
+            if chunk_size is None:
+                chunk_size = length
+            if length != chunk_size or offset != idx * chunk_size:
+                return f"chunk {idx} at {offset}+{length} doesn't match chunk size {chunk_size}"
+        else:
+            if offset + length != self.filesize:
+                return f"last chunk ends at {offset + length}, not {self.filesize}"
+            if chunk_size is None and idx > 0 and offset % idx == 0:
+                chunk_size = offset // idx
+            if chunk_size is not None and offset != idx * chunk_size:
+                return f"last chunk at {offset} doesn't match chunk size {chunk_size}"
+        if chunk_size is not None and (chunk_size <= 0 or (self.filesize + chunk_size - 1) // chunk_size != total):
+            return f"{total} chunks of {chunk_size} bytes don't make {self.filesize} bytes"
+        self.chunk_size = chunk_size
+        return None
+
+    def write_chunk(self, idx: int, total: int, offset: int, data) -> bool:
+        """Write one decoded chunk. Returns False for duplicates and chunks that don't fit the file."""
+        with self._lock:
+            if self.discarded:
+                return False  # Rejected or expired while this chunk was in flight
+            if self.total_chunks is not None and self.total_chunks != total:
+                log("Total chunks mismatch")
+                return False
+            reason = self._check_chunk(idx, total, offset, len(data))
+            if reason is not None:
+                log(f"Dropping chunk for {self.filename}: {reason}")
+                return False
+            if self.total_chunks is None:
+                self.total_chunks = total
+                self.bitmap = bytearray((total + 7) // 8)
+            if self.has_chunk(idx):
+                return False
+            if self._fd is None:
+                self._open()
+            self._pwrite(data, offset)
+            self.bitmap[idx >> 3] |= 1 << (idx & 7)
+            self.received_count += 1
+            self.highest_chunk = max(self.highest_chunk, idx)
+            self.timestamp = time.time()
+            return True
+
+    @property
+    def complete(self) -> bool:
+        return self.total_chunks is not None and self.received_count == self.total_chunks
+
+    def missing_ranges(self, limit: int = MAX_NACK_RANGES):
+        """Up to limit (start, end) ranges of chunks not yet received, inclusive."""
+        ranges = []
+        with self._lock:
+            if self.total_chunks is None:
+                return ranges
+            start = None
+            for idx in range(self.total_chunks):
+                if not self.has_chunk(idx):
+                    if start is None:
+                        start = idx
+                elif start is not None:
+                    ranges.append((start, idx - 1))
+                    start = None
+                    if len(ranges) == limit:
+                        return ranges
+            if start is not None:
+                ranges.append((start, self.total_chunks - 1))
+        return ranges
+
+    def finish(self) -> str:
+        """Close the .part file and atomically rename it to a free name. Returns the final path."""
+        with self._lock:
+            if self.discarded:
+                raise RuntimeError(f"{self.filename} was discarded")
+            if self._fd is None:
+                self._open()  # Empty file: nothing was ever written
+            os.close(self._fd)
+            self._fd = None
+            path = unique_path(self.filename)
+            os.replace(self.part_path, path)
+            return path
+
+    def discard(self):
+        with self._lock:
+            self.discarded = True
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+
+def send_file_control(msg_type: str, target: str, fileid: str, **fields):
+    """Send a small FILE_* control message (FILE_ACCEPT, FILE_REJECT, ...) to one peer."""
+    timestamp = int(time.time())
+    msg_id = hex(random.getrandbits(64))[2:]
+    token = f"{USER_ID}|{timestamp+TTL_DEFAULT}|file"
+    send_to(target, build_message({
+        "TYPE": msg_type,
+        "FROM": USER_ID,
+        "TO": target,
+        "FILEID": fileid,
+        **fields,
+        "TIMESTAMP": timestamp,
+        "MESSAGE_ID": msg_id,
+        "TOKEN": token
+    }))
+
+def format_ranges(ranges) -> str:
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+def parse_ranges(text: str):
+    """Yield every index in a "0-4,7,9-12" style range list."""
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        a, _, b = part.partition("-")
+        yield from range(int(a), int(b or a) + 1)
+
+def send_nack(file_rec: IncomingFile) -> bool:
+    """Ask the sender to resend the chunks we're missing. False if nothing is missing."""
+    ranges = file_rec.missing_ranges()
+    if not ranges:
+        return False
+    file_rec.last_nack = time.time()
+    send_file_control("FILE_NACK", file_rec.sender, file_rec.fileid, MISSING=format_ranges(ranges),
+                      RECEIVED=file_rec.received_count, HIGHEST=file_rec.highest_chunk)
+    log(f"NACK for {file_rec.filename}: {format_ranges(ranges)}")
+    return True
+
+def resume_file(fileid: str):
+    """Ask the sender of a stalled transfer for the chunks we're missing. Returns its record, or None."""
+    file_rec = incoming_files.get(fileid)
+    if file_rec is None or not file_rec.accepted:
+        return None
+    send_nack(file_rec)
+    return file_rec
+
+def _watch_stall(fileid: str):
+    """Timer: NACK an accepted transfer whose chunks stopped arriving. Re-arms until the file is done."""
+    file_rec = incoming_files.get(fileid)
+    if file_rec is None:
+        return  # Completed, rejected or expired
+    now = time.time()
+    due = max(file_rec.timestamp, file_rec.last_nack) + STALL_TIMEOUT
+    if now >= due:
+        if file_rec.total_chunks is not None and peer_supports(file_rec.sender, "FILE_NACK"):
+            send_nack(file_rec)
+        due = now + STALL_TIMEOUT
+    call_later(due - now, _watch_stall, fileid)
+
+def accept_file(fileid: str):
+    """Accept an offered file and tell the sender. Returns its record, or None if unknown/expired."""
+    file_rec = incoming_files.get(fileid)
+    if file_rec is not None:
+        file_rec.accept()
+        send_file_control("FILE_ACCEPT", file_rec.sender, fileid)
+        call_later(STALL_TIMEOUT, _watch_stall, fileid)
+    return file_rec
+
+def reject_file(fileid: str):
+    """Decline an offered file and tell the sender. Returns its record, or None if unknown/expired."""
+    with incoming_locks.for_key(fileid):
+        file_rec = incoming_files.pop(fileid, None)
+    if file_rec is not None:
+        file_rec.discard()
+        send_file_control("FILE_REJECT", file_rec.sender, fileid)
+    return file_rec
+
+def _watch_expiry(fileid: str):
+    """Timer: drop an offer nobody accepted, or a partial file left idle too long."""
+    file_rec = incoming_files.get(fileid)
+    if file_rec is None:
+        return
+    limit = RESUME_TIMEOUT if file_rec.received_count else OFFER_TIMEOUT
+    remaining = file_rec.timestamp + limit - time.time()
+    if remaining > 0:
+        call_later(remaining, _watch_expiry, fileid)  # There was activity; check again when it could expire
+        return
+    with incoming_locks.for_key(fileid):
+        if incoming_files.get(fileid) is not file_rec:
+            return
+        del incoming_files[fileid]
+    file_rec.discard()
+    log(f"Expired file offer: {fileid}")
+
+@register("FILE_OFFER")
+def handle_file_offer(msg, sender_id):
+    if msg.get("TO") == USER_ID:
+        fileid = msg.get("FILEID")
+        if not valid_fileid(fileid):
+            log(f"Refusing file offer from {sender_id} with invalid FILEID {fileid!r}")
+            return
+        if msg.get("SHA256"):
+            # The digest lookup may have to hash received_files/ first
+            in_background(_register_offer, msg)
+        else:
+            _register_offer(msg)
+
+def _register_offer(msg):
+    """Record an offer and prompt the user, unless we already hold its content."""
+    fileid = msg.get("FILEID")
+    digest = msg.get("SHA256")
+    if digest and copy_existing(msg, digest):
+        return
+
+    with incoming_locks.for_key(fileid):
+        # Skip if already processing
+        if fileid in incoming_files:
+            return
+
+        incoming_files[fileid] = IncomingFile(
+            fileid,
+            msg.get("FROM"),
+            msg.get("FILENAME"),
+            msg.get("FILESIZE"),
+            msg.get("FILETYPE"),
+            msg.get("DESCRIPTION", ""),
+            digest,
+        )
+    call_later(OFFER_TIMEOUT, _watch_expiry, fileid)
+
+    display_name = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
+    print_non_verbose(f"User {display_name} is sending you a file. Do you accept? (Type 'accept {fileid}')")
+
+def copy_existing(msg, digest: str) -> bool:
+    """Satisfy an offer from a file we already hold; True if the transfer can be skipped."""
+    existing = content_index.lookup(digest)
+    if existing is None:
+        return False
+    filename = safe_filename(msg.get("FILENAME"), msg.get("FILEID"))
+    path = existing
+    if os.path.basename(existing) != filename:
+        path = unique_path(filename)
+        try:
+            os.link(existing, path)  # Same content: share the data on disk
+        except OSError:
+            shutil.copyfile(existing, path)
+        content_index.add(path)
+    send_file_control("FILE_RECEIVED", msg.get("FROM"), msg.get("FILEID"), STATUS="DUPLICATE")
+    display_name = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
+    print_non_verbose(f"{display_name} offered {filename}, which you already have ({path})")
+    return True
+
+@register("FILE_CHUNK")
+def handle_file_chunk(msg, sender_id):
+    fileid = msg.get("FILEID")
+    file_rec = incoming_files.get(fileid)  # Single lookup; the record has its own lock
+
+    if file_rec is None or not file_rec.accepted:
+        log(f"Ignoring chunk for unaccepted file: {fileid}")
+        return
+
+    idx = int(msg.get("CHUNK_INDEX"))
+    total = int(msg.get("TOTAL_CHUNKS"))
+    # Older senders don't send OFFSET; they always used fixed-size chunks
+    offset = int(msg.get("OFFSET", idx * FILE_CHUNK_SIZE))
+
+    if msg.get("ENCODING") == "binary":
+        data = msg.body()
+    else:
+        data = base64.b64decode(msg.raw("DATA"))
+    method = msg.get("COMPRESSION")
+    if method:
+        try:
+            data = decompress_chunk(method, data)
+        except (ValueError, zlib.error, lzma.LZMAError) as e:
+            log(f"Dropping chunk {idx} of {fileid}: {e}")
+            return  # Treated as lost, so it gets NACKed and resent
+
+    if not file_rec.write_chunk(idx, total, offset, data):
+        return
+    log(f"Received chunk {idx+1}/{total} for {file_rec.filename}")
+
+    if file_rec.complete:
+        complete_file(file_rec)
+    elif idx == total - 1 and peer_supports(sender_id, "FILE_NACK"):
+        send_nack(file_rec)  # The last chunk arrived but some earlier ones didn't
+    elif file_rec.received_count % ACK_EVERY == 0 and peer_supports(sender_id, "FILE_ACK"):
+        send_file_control("FILE_ACK", file_rec.sender, fileid,
+                          RECEIVED=file_rec.received_count, HIGHEST=file_rec.highest_chunk)
+
+def complete_file(file_rec: IncomingFile):
+    """Move a fully received file into place and tell the sender."""
+    with incoming_locks.for_key(file_rec.fileid):
+        if incoming_files.pop(file_rec.fileid, None) is None:
+            return  # Another worker already finished it
+    in_background(_finish_file, file_rec)  # Renaming and hashing stay off the handler
+
+def _finish_file(file_rec: IncomingFile):
+    try:
+        path = file_rec.finish()
+        digest = content_index.add(path)
+        if file_rec.digest and file_rec.digest != digest:
+            print_non_verbose(f"Warning: {file_rec.filename} does not match the sender's checksum")
+        print_non_verbose(f"File transfer of {file_rec.filename} is complete")
+        send_file_control("FILE_RECEIVED", file_rec.sender, file_rec.fileid, STATUS="COMPLETE")
+
+    except Exception as e:
+        log(f"File reassembly failed: {e}")
+
+UNFINISHED_STATES = ("offered", "accepted", "sending", "sent")
+
+def _answer_offer(msg, sender_id, state: str, from_states=("offered",)):
+    with transfers_lock:
+        transfer = outgoing_transfers.get(msg.get("FILEID"))
+    if transfer is None or transfer.target != sender_id:
+        return
+    if transfer.state in from_states:
+        transfer.state = state
+        log(f"File {transfer.fileid} {state} by {sender_id}")
+        scheduler.wake(transfer)
+
+@register("FILE_ACCEPT")
+def handle_file_accept(msg, sender_id):
+    _answer_offer(msg, sender_id, "accepted")
+
+@register("FILE_REJECT")
+def handle_file_reject(msg, sender_id):
+    # The receiver can decline (or drop) a file at any point before it has all of it
+    _answer_offer(msg, sender_id, "rejected", UNFINISHED_STATES)
+
+@register("FILE_ACK")
+def handle_file_ack(msg, sender_id):
+    with transfers_lock:
+        transfer = outgoing_transfers.get(msg.get("FILEID"))
+    if transfer is None or transfer.target != sender_id or transfer.flow is None:
+        return
+    transfer.flow.on_ack(int(msg.get("RECEIVED", 0)), int(msg.get("HIGHEST", -1)))
+
+@register("FILE_NACK")
+def handle_file_nack(msg, sender_id):
+    with transfers_lock:
+        transfer = outgoing_transfers.get(msg.get("FILEID"))
+    if transfer is None or transfer.target != sender_id:
+        log(f"FILE_NACK for unknown transfer {msg.get('FILEID')}")
+        return
+    transfer.queue_resend(parse_ranges(msg.get("MISSING", "")))
+    scheduler.wake(transfer)
+    if transfer.flow is not None:
+        transfer.flow.on_ack(int(msg.get("RECEIVED", 0)), int(msg.get("HIGHEST", -1)))
+
+@register("FILE_RECEIVED")
+def handle_file_received(msg, sender_id):
+    with transfers_lock:
+        transfer = outgoing_transfers.get(msg.get("FILEID"))
+    if transfer is not None and transfer.target == sender_id:
+        transfer.state = "complete"
+        scheduler.wake(transfer)  # Stop lingering for NACKs
+    log(f"File {msg.get('FILEID')} received by {msg.get('FROM')}")
+
+def decompress_chunk(method: str, data) -> bytes:
+    """Undo a chunk's COMPRESSION. Output is capped at one datagram's worth of bytes."""
+    if method == "zlib":
+        d = zlib.decompressobj()
+    elif method == "lzma":
+        d = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"unknown compression {method}")
+    out = d.decompress(data, BUFFER_SIZE)
+    if not d.eof:
+        raise ValueError("compressed chunk is truncated or too large")
+    return out
+
+class ChunkCompressor:
+    """Compresses chunks for one transfer, and stops trying if the file doesn't shrink.
+
+    The first COMPRESS_SAMPLE_CHUNKS chunks are always tried; if together they
+    don't get below COMPRESS_MIN_RATIO (media, archives) compression is turned
+    off for the rest of the file. Any chunk that doesn't shrink is sent raw.
+    """
+
+    def __init__(self, method: str):
+        self.method = method
+        self.enabled = True
+        self.sampled = 0
+        self.raw_bytes = 0
+        self.packed_bytes = 0
+
+    def _compress(self, chunk: bytes) -> bytes:
+        if self.method == "lzma":
+            return lzma.compress(chunk, preset=LZMA_PRESET)
+        return zlib.compress(chunk, ZLIB_LEVEL)
+
+    def compress(self, chunk: bytes):
+        """Return (data, method); method is None when the chunk goes out raw."""
+        if not self.enabled:
+            return chunk, None
+        packed = self._compress(chunk)
+        self.raw_bytes += len(chunk)
+        self.packed_bytes += min(len(packed), len(chunk))
+        if self.sampled < COMPRESS_SAMPLE_CHUNKS:
+            self.sampled += 1
+            if self.sampled == COMPRESS_SAMPLE_CHUNKS and self.ratio > COMPRESS_MIN_RATIO:
+                self.enabled = False
+                log(f"Chunks only compress to {self.ratio:.0%}, sending the rest raw")
+        if len(packed) >= len(chunk):
+            return chunk, None
+        return packed, self.method
+
+    @property
+    def ratio(self) -> float:
+        return self.packed_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+class OutgoingFile:
+    """Sender-side state for one transfer.
+
+    Chunks are read on demand with positional reads, so memory use is
+    bounded by the read-ahead window no matter how large the file is.
+    """
+
+    def __init__(self, fileid, target, path, chunk_size=FILE_CHUNK_SIZE):
+        self.fileid = fileid
+        self.target = target
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.filesize = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.total_chunks = (self.filesize + chunk_size - 1) // chunk_size
+        self.sent_chunks = 0
+        self.bytes_sent = 0
+        self.wire_bytes = 0  # Datagram bytes, charged to the scheduler's budget
+        self.priority = DEFAULT_PRIORITY
+        self.state = "offered"
+        self.started = time.time()
+        self.flow = None  # FlowControl when the receiver acknowledges chunks
+        self.compressor = None  # ChunkCompressor when the receiver can decompress
+        self.digest = None  # Future for the file's SHA-256
+        self.resent_chunks = 0
+        self._resend = deque()   # Chunk indexes the receiver reported missing
+        self._resend_set = set()
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        self._read_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def read_chunk(self, idx: int) -> bytes:
+        offset = idx * self.chunk_size
+        if hasattr(os, "pread"):
+            return os.pread(self._fd, self.chunk_size, offset)
+        with self._read_lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, self.chunk_size)
+
+    def chunks(self, readahead: int = READAHEAD_CHUNKS):
+        """Yield (idx, offset, data), keeping at most readahead chunks in memory."""
+        window = deque()
+        next_read = 0
+        while window or next_read < self.total_chunks:
+            while next_read < self.total_chunks and len(window) < readahead:
+                window.append((next_read, self.read_chunk(next_read)))
+                next_read += 1
+            idx, data = window.popleft()
+            yield idx, idx * self.chunk_size, data
+
+    def queue_resend(self, indexes):
+        with self._lock:
+            for idx in indexes:
+                if 0 <= idx < self.total_chunks and idx not in self._resend_set:
+                    self._resend.append(idx)
+                    self._resend_set.add(idx)
+
+    def next_resend(self):
+        with self._lock:
+            if not self._resend:
+                return None
+            idx = self._resend.popleft()
+            self._resend_set.discard(idx)
+            return idx
+
+    def send(self, message):
+        send_to(self.target, message)
+        self.wire_bytes += len(message)
+
+    def record_sent(self, nbytes: int):
+        self.sent_chunks += 1
+        self.bytes_sent += nbytes
+
+    @property
+    def percent(self) -> float:
+        return 100.0 * self.sent_chunks / self.total_chunks if self.total_chunks else 100.0
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class FlowControl:
+    """Token-bucket pacing plus a window of unacknowledged chunks.
+
+    The rate grows while acks show the receiver keeping up (fast growth
+    until the first loss, then steadier) and halves, together with the
+    window, when acks reveal new gaps or stop arriving. Like TCP, it backs
+    off at most once per window of data so one burst of loss isn't punished
+    repeatedly.
+    """
+
+    def __init__(self, rate: float = INITIAL_RATE, window: int = INITIAL_WINDOW):
+        self.rate = rate
+        self.window = window
+        self.tokens = 1.0
+        self.sent = 0
+        self.received = 0       # Receiver's count of distinct chunks
+        self.lost = 0           # Chunks we've given up counting as in flight
+        self.slow_start = True
+        self.timeouts = 0       # Ack timeouts since the last ack
+        self._recover_until = 0  # No further gap back-off until received passes this
+        self._last_refill = time.monotonic()
+        self._last_ack = self._last_refill
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self.sent - self.received - self.lost
+
+    def delay(self) -> float:
+        """Seconds until the next chunk may be sent (0 means now)."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(max(1.0, self.rate / 10), self.tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self.in_flight >= self.window:
+                if now - self._last_ack < ACK_TIMEOUT:
+                    return min(0.05, ACK_TIMEOUT - (now - self._last_ack))
+                # Window stuck: assume what's in flight was dropped
+                self.lost = self.sent - self.received
+                self.timeouts += 1
+                self._back_off()
+                self._last_ack = now
+            if self.tokens >= 1.0:
+                return 0.0
+            return (1.0 - self.tokens) / self.rate
+
+    def on_send(self, resend: bool = False):
+        with self._lock:
+            self.tokens -= 1.0
+            if not resend:
+                # A resend replaces a chunk already counted as lost, so it isn't windowed
+                self.sent += 1
+
+    @property
+    def stalled(self) -> bool:
+        """True once the receiver has gone MAX_ACK_TIMEOUTS windows without acking."""
+        return self.timeouts >= MAX_ACK_TIMEOUTS
+
+    def check_silence(self) -> bool:
+        """With chunks unacknowledged, count each ACK_TIMEOUT of silence as a timeout. Returns stalled."""
+        with self._lock:
+            now = time.monotonic()
+            if self.in_flight > 0 and now - self._last_ack >= ACK_TIMEOUT:
+                self.timeouts += 1
+                self._last_ack = now
+        return self.stalled
+
+    def on_ack(self, received: int, highest: int):
+        with self._lock:
+            self._last_ack = time.monotonic()
+            self.timeouts = 0
+            if received <= self.received:
+                return
+            self.received = received
+            gaps = max(0, highest + 1 - received)
+            new_loss = gaps > self.lost
+            self.lost = gaps
+            if new_loss and received >= self._recover_until:
+                self._back_off()
+            elif not new_loss:
+                if self.slow_start:
+                    self.rate = min(MAX_RATE, self.rate * 1.5)
+                    self.window = min(MAX_WINDOW, self.window * 2)
+                else:
+                    self.rate = min(MAX_RATE, self.rate + max(INITIAL_RATE / 4, self.rate / 8))
+                    self.window = min(MAX_WINDOW, self.window + ACK_EVERY // 2)
+
+    def _back_off(self):
+        self.slow_start = False
+        self._recover_until = self.sent
+        self.rate = max(MIN_RATE, self.rate / 2)
+        self.window = max(MIN_WINDOW, self.window // 2)
+        log(f"Flow control backing off: {self.rate:.0f} chunks/s, window {self.window}")
+
+def build_chunk(builder: MessageBuilder, transfer: OutgoingFile, idx: int, offset: int, chunk: bytes, binary: bool):
+    """Encode one FILE_CHUNK into builder's buffer (binary body or base64 DATA)."""
+    method = None
+    if transfer.compressor is not None:
+        chunk, method = transfer.compressor.compress(chunk)
+    data = chunk if binary else base64.b64encode(chunk)
+    timestamp = int(time.time())
+    msg_id = hex(random.getrandbits(64))[2:]
+    token = f"{USER_ID}|{timestamp+TTL_DEFAULT}|file"
+    fields = {
+        "TYPE": "FILE_CHUNK",
+        "FROM": USER_ID,
+        "TO": transfer.target,
+        "FILEID": transfer.fileid,
+        "CHUNK_INDEX": idx,
+        "TOTAL_CHUNKS": transfer.total_chunks,
+        "OFFSET": offset,
+        "CHUNK_SIZE": len(data),
+        "TIMESTAMP": timestamp,
+        "MESSAGE_ID": msg_id,
+        "TOKEN": token
+    }
+    if method:
+        fields["COMPRESSION"] = method
+    if binary:
+        fields["ENCODING"] = "binary"
+        return builder.build(fields, body=data)
+    fields["DATA"] = data
+    return builder.build(fields)
+
+def print_progress(transfer: OutgoingFile):
+    """Default progress callback: log every chunk, print each 25% step."""
+    log(f"Sent chunk {transfer.sent_chunks}/{transfer.total_chunks} of {transfer.filename}")
+    step = max(1, (transfer.total_chunks + 3) // 4)
+    if transfer.sent_chunks % step == 0 and transfer.sent_chunks != transfer.total_chunks:
+        print_non_verbose(f"Sending {transfer.filename}: {transfer.percent:.0f}%")
+
+def list_transfers():
+    """Print outgoing transfers and their progress."""
+    with transfers_lock:
+        transfers = list(outgoing_transfers.values())
+    if not transfers:
+        print_non_verbose("No active transfers")
+        return
+    print_non_verbose("Outgoing transfers:")
+    for t in transfers:
+        name = peers.get(t.target, {}).get("display_name", t.target)
+        print_non_verbose(f"  {t.fileid} {t.filename} -> {name}: {t.state}, "
+                          f"{t.sent_chunks}/{t.total_chunks} chunks ({t.percent:.0f}%), priority {t.priority}")
+
+def prepare_transfer(target: str, file_path: str, priority: int = DEFAULT_PRIORITY):
+    """Check the file and register an OutgoingFile for it. Returns None if it can't be sent."""
+    
+    # Debug information
+    print(f"DEBUG: Current directory: {os.getcwd()}")
+    print(f"DEBUG: Looking for file: '{file_path}'")
+    print(f"DEBUG: Full path: '{os.path.abspath(file_path)}'")
+    print(f"DEBUG: File exists: {os.path.exists(file_path)}")
+    
+    
+    target_dir = os.path.dirname(file_path) if os.path.dirname(file_path) else "."
+    print(f"DEBUG: Files in directory '{target_dir}':")
+    try:
+        for file in os.listdir(target_dir):
+            if os.path.isfile(os.path.join(target_dir, file)):
+                full_path = os.path.join(target_dir, file)
+                size = os.path.getsize(full_path)
+                print(f"  - {file} ({size} bytes)")
+    except Exception as e:
+        print(f"  Error listing directory: {e}")
+    
+    if not os.path.exists(file_path):
+        print("File not found")
+        return None
+
+    state = peer_state(target)
+    if state is None:
+        print(f"{target} is not a known peer (or has left)")
+        return None
+    if state == "stale":
+        print(f"Warning: {target} hasn't been heard from recently")
+
+    fileid = hex(random.getrandbits(128))[2:]
+    transfer = OutgoingFile(fileid, target, file_path)
+    transfer.priority = priority
+    transfer.digest = in_background(file_digest, file_path)  # Hashed while the transfer waits its turn
+    print(f"DEBUG: File found! Size: {transfer.filesize} bytes")
+
+    # Registered before the offer goes out so FILE_ACCEPT/FILE_REJECT can find it
+    with transfers_lock:
+        outgoing_transfers[fileid] = transfer
+    return transfer
+
+def transfer_steps(transfer: OutgoingFile, description: str = "", progress=print_progress):
+    """Offer and stream a file one step at a time, yielding each pause (in seconds).
+
+    Every resume does at most one chunk of work, so the TransferScheduler can
+    interleave transfers; a pause of 0 means "ready again right away".
+    progress(transfer) is called after every chunk.
+    """
+    target = transfer.target
+    fileid = transfer.fileid
+    filename = transfer.filename
+    try:
+        while not transfer.digest.done():
+            yield ACCEPT_POLL_INTERVAL
+        digest = transfer.digest.result()  # Streamed and cached, so resends of the same file are free
+
+        timestamp = int(time.time())
+        msg_id = hex(random.getrandbits(64))[2:]
+        token = f"{USER_ID}|{timestamp+TTL_DEFAULT}|file"
+        offer_msg = build_message({
+            "TYPE": "FILE_OFFER",
+            "FROM": USER_ID,
+            "TO": target,
+            "FILENAME": filename,
+            "FILESIZE": transfer.filesize,
+            "FILETYPE": "application/octet-stream",
+            "FILEID": fileid,
+            "DESCRIPTION": description,
+            "SHA256": digest,
+            "TIMESTAMP": timestamp,
+            "MESSAGE_ID": msg_id,
+            "TOKEN": token
+        })
+        send_to(target, offer_msg)
+
+        if peer_supports(target, "FILE_ACCEPT"):
+            # Start as soon as the receiver answers instead of sleeping a fixed 20 seconds
+            print(f"File offer sent for {filename}. Waiting for acceptance...")
+            deadline = time.time() + FILE_ACCEPT_TIMEOUT
+            while transfer.state == "offered":
+                if time.time() >= deadline:
+                    transfer.state = "timed out"
+                    print(f"File offer for {filename} was not answered, aborting")
+                    return
+                yield ACCEPT_POLL_INTERVAL
+            if transfer.state == "rejected":
+                print(f"File offer for {filename} was rejected")
+                return
+        else:
+            # Older peers never answer an offer; give them time to type 'accept'
+            print(f"File offer sent for {filename}. DEBUG: Waiting 20 seconds for acceptance...")
+            yield 20
+
+        if transfer.state == "complete":
+            print(f"{target} already has {filename}, nothing to send")
+            return
+
+        # Peers that advertise BINARY_CHUNK get raw bytes after the header instead of base64 DATA
+        binary = peer_supports(target, "BINARY_CHUNK")
+        transfer.state = "sending"
+        print(f"DEBUG: File split into {transfer.total_chunks} chunks")
+
+        if peer_supports(target, "FILE_ACK"):
+            transfer.flow = FlowControl()
+        if config.FILE_COMPRESSION in ("zlib", "lzma") and peer_supports(target, "COMPRESSION"):
+            transfer.compressor = ChunkCompressor(config.FILE_COMPRESSION)
+        flow = transfer.flow
+
+        builder = MessageBuilder()  # DATA stays bytes; encoded straight into one buffer
+        for idx, offset, chunk in transfer.chunks():
+            if flow is not None:
+                while (delay := flow.delay()) > 0:
+                    yield delay
+                if flow.stalled:
+                    transfer.state = "stalled"
+            if transfer.state != "sending":
+                break  # Rejected mid-transfer, or FILE_RECEIVED says it's all there
+            if flow is not None:
+                flow.on_send()
+            transfer.send(build_chunk(builder, transfer, idx, offset, chunk, binary))
+            transfer.record_sent(len(chunk))
+            if progress is not None:
+                progress(transfer)
+            yield 0 if flow is not None else LEGACY_CHUNK_DELAY  # Legacy pacing prevents flooding
+
+        if transfer.state == "rejected":
+            print(f"{target} rejected {filename}, stopped sending")
+            return
+        if transfer.state == "stalled":
+            print(f"{target} stopped acknowledging {filename}, giving up after {transfer.sent_chunks}/{transfer.total_chunks} chunks")
+            return
+        if transfer.state == "sending":  # FILE_RECEIVED may already have marked it complete
+            transfer.state = "sent"
+        print(f"Sent {filename} in {transfer.total_chunks} chunks")
+        if transfer.compressor is not None and transfer.compressor.enabled:
+            print(f"Compressed to {transfer.compressor.ratio:.0%} with {transfer.compressor.method}")
+
+        if not peer_supports(target, "FILE_NACK"):
+            return
+
+        # Stay around to resend whatever the receiver reports missing
+        idle_deadline = time.time() + RESEND_LINGER
+        while transfer.state == "sent" and time.time() < idle_deadline:
+            idx = transfer.next_resend()
+            if idx is None:
+                if flow is not None and flow.check_silence():
+                    transfer.state = "stalled"
+                    print(f"{target} stopped acknowledging {filename}, giving up")
+                    break
+                wait = max(0.0, idle_deadline - time.time())  # handle_file_nack wakes us sooner
+                if flow is not None and flow.in_flight > 0:
+                    wait = min(wait, ACK_TIMEOUT)  # Still expecting acks; keep counting the silence
+                yield wait
+                continue
+            if flow is not None:
+                while (delay := flow.delay()) > 0:
+                    yield delay
+                if flow.stalled:
+                    transfer.state = "stalled"
+                    print(f"{target} stopped acknowledging resends of {filename}, giving up")
+            if transfer.state != "sent":
+                break  # Rejected, completed or stalled while we waited
+            if flow is not None:
+                flow.on_send(resend=True)
+            offset = idx * transfer.chunk_size
+            transfer.send(build_chunk(builder, transfer, idx, offset, transfer.read_chunk(idx), binary))
+            transfer.resent_chunks += 1
+            idle_deadline = time.time() + RESEND_LINGER
+            yield 0 if flow is not None else LEGACY_CHUNK_DELAY
+        if transfer.resent_chunks:
+            log(f"Resent {transfer.resent_chunks} chunks of {filename}")
+    finally:
+        transfer.close()
+        with transfers_lock:
+            outgoing_transfers.pop(fileid, None)
+
+class _Job:
+    __slots__ = ("transfer", "steps", "ready_at", "vtime")
+
+    def __init__(self, transfer, steps, vtime):
+        self.transfer = transfer
+        self.steps = steps
+        self.ready_at = 0.0
+        self.vtime = vtime
+
+class TransferScheduler:
+    """Owns every outgoing transfer and interleaves their chunks.
+
+    Each transfer is a transfer_steps generator. Ready transfers take turns
+    by weighted fair queuing on bytes sent (weight = priority), and together
+    they draw from one token bucket of `bandwidth` bytes/s, set below link
+    speed so chat traffic always has headroom. One thread (or the asyncio
+    loop) drives all of them.
+    """
+
+    def __init__(self, bandwidth: float = None):
+        self.bandwidth = bandwidth or config.FILE_BANDWIDTH
+        self.waker = None  # Called when work is submitted (set by the asyncio driver)
+        self._jobs = []
+        self._tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._pending = False
+        self._cond = threading.Condition()
+
+    def submit(self, transfer: OutgoingFile, steps):
+        with self._cond:
+            # Start level with the others so a new transfer can't starve them
+            vtime = min((j.vtime for j in self._jobs), default=0.0)
+            self._jobs.append(_Job(transfer, steps, vtime))
+            self._pending = True
+            self._cond.notify()
+        if self.waker is not None:
+            self.waker()
+
+    def poll(self):
+        """Run at most one ready step. Returns seconds until work is due, or None when idle."""
+        with self._cond:
+            now = time.monotonic()
+            burst = max(self.bandwidth * 0.05, 2 * BUFFER_SIZE)
+            self._tokens = min(burst, self._tokens + (now - self._last_refill) * self.bandwidth)
+            self._last_refill = now
+            if not self._jobs:
+                return None
+            ready = [j for j in self._jobs if j.ready_at <= now]
+            if not ready:
+                return min(j.ready_at for j in self._jobs) - now
+            if self._tokens < 0:
+                return -self._tokens / self.bandwidth  # Shared budget used up
+            job = min(ready, key=lambda j: j.vtime)
+
+        before = job.transfer.wire_bytes
+        try:
+            delay = next(job.steps)
+        except StopIteration:
+            delay = None
+        except Exception as e:
+            print(f"File send failed: {e}")
+            delay = None
+
+        with self._cond:
+            if delay is None:
+                self._jobs.remove(job)
+                return 0.0
+            sent = job.transfer.wire_bytes - before
+            self._tokens -= sent
+            job.vtime += sent / max(1, job.transfer.priority)
+            job.ready_at = time.monotonic() + delay
+        return 0.0
+
+    def run(self):
+        """Thread driver: poll forever, sleeping until the next step is due."""
+        while True:
+            delay = self.poll()
+            if delay == 0:
+                continue
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait(delay)
+                self._pending = False
+
+    def wake(self, transfer: OutgoingFile):
+        """Make a transfer's next step due now, e.g. after a NACK while it sat idle."""
+        with self._cond:
+            for job in self._jobs:
+                if job.transfer is transfer:
+                    job.ready_at = 0.0
+            self._pending = True
+            self._cond.notify()
+        if self.waker is not None:
+            self.waker()
+
+    def set_priority(self, fileid: str, priority: int) -> bool:
+        with transfers_lock:
+            transfer = outgoing_transfers.get(fileid)
+        if transfer is None:
+            return False
+        transfer.priority = max(1, priority)
+        return True
+
+scheduler = TransferScheduler()
+
+def send_file(target: str, file_path: str, description: str = "", priority: int = DEFAULT_PRIORITY):
+    """Queue a file on the shared transfer scheduler. Returns its OutgoingFile, or None."""
+    try:
+        transfer = prepare_transfer(target, file_path, priority)
+        if transfer is not None:
+            scheduler.submit(transfer, transfer_steps(transfer, description))
+        return transfer
+    except Exception as e:
+        print(f"File send failed: {e}")
+        return None
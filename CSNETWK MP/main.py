@@ -1,239 +1,169 @@
-import os
 import threading
 import time
 import random
 import config
-import base64
-from config import USER_ID, DISPLAY_NAME, STATUS, TTL_DEFAULT
-from parser import build_message, parse_message
-from network import send_broadcast, listen
-from storage import peers, posts, dms, followers, groups, likes, storage_lock, incoming_files
+import network
+from config import USER_ID, TTL_DEFAULT, STORAGE_SWEEP_INTERVAL
+from parser import build_message, parse_bytes, peek_field
+from dispatch import handlers, register, seen_messages
+from tokens import check as check_token  # also registers the REVOKE handler
+from network import send_broadcast, send_to, listen, sender, coalescer, split_bundle, BUNDLE_PREFIX
+from storage import peers, peers_view, online_peers, seen_peer, posts_view, dms_view, followers_view, groups_view, add_post, find_post, record_like, like_count, add_like, sweep, stats, add_dm, add_follower, remove_follower, set_group, update_group_members, open_store, close_store
 from logger import print_non_verbose, log
+from filetransfer import accept_file, reject_file, resume_file, send_file, list_transfers, scheduler  # also registers FILE_* handlers
+from presence import heartbeat, set_status, leave  # also registers PING/PROFILE/LEAVE handlers
+from timers import timers, call_every
+from tictactoe import send_tictactoe_invite, send_tictactoe_move, list_active_games  # also registers TICTACTOE_* handlers
 
-def handle_message(raw_msg: str, addr):
+_USER_ID_BYTES = USER_ID.encode()
+
+def handle_message(raw_msg: bytes, addr):
     try:
-        msg = parse_message(raw_msg)
-        msg_type = msg.get("TYPE")
-        sender_id = msg.get("USER_ID") or msg.get("FROM")
+        if isinstance(raw_msg, str):
+            raw_msg = raw_msg.encode("utf-8")
+
+        # Cheap peek at the raw bytes before parsing: most LAN traffic isn't for us
+        sender_raw = peek_field(raw_msg, "USER_ID") or peek_field(raw_msg, "FROM")
 
-        if sender_id == USER_ID:
+        if sender_raw == _USER_ID_BYTES:
            return  # Ignore self
-        
-        # PING
-        if msg_type == "PING":
-            log(f"PING received from {sender_id}")
-            return
 
-        # PROFILE
-        if msg_type == "PROFILE":
-            display_name = msg.get("DISPLAY_NAME", sender_id)
-            status = msg.get("STATUS", "")
-            if sender_id not in peers or peers[sender_id]["status"] != status:
-                peers[sender_id] = {"display_name": display_name, "status": status}
-                print_non_verbose(f"[PROFILE] {display_name} - {status}")
-
-        # POST
-        elif msg_type == "POST":
-            posts.append({"user_id": sender_id, "content": msg.get("CONTENT", ""), "timestamp": msg.get("TTL")})
-            display_name = peers.get(sender_id, {}).get("display_name", sender_id)
-            print_non_verbose(f"[POST] {display_name}: {msg.get('CONTENT')}")
-
-        # DM
-        elif msg_type == "DM":
-            dms.append({"from": msg.get("FROM"), "to": msg.get("TO"), "content": msg.get("CONTENT")})
-            sender = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
-            print_non_verbose(f"[DM] {sender}: {msg.get('CONTENT')}")
-
-        # FOLLOW
-        elif msg_type == "FOLLOW":
-            followers.add(sender_id)
-            print_non_verbose(f"User {sender_id} has followed you")
-
-        # UNFOLLOW
-        elif msg_type == "UNFOLLOW":
-            if sender_id in followers:
-                followers.remove(sender_id)
-            print_non_verbose(f"User {sender_id} has unfollowed you")
-
-        # LIKE
-        elif msg_type == "LIKE":
-            likes.append({"from": msg.get("FROM"), "to": msg.get("TO"), "post_timestamp": msg.get("POST_TIMESTAMP"), "action": msg.get("ACTION")})
-            liker = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
-
-            post_content = None
-            for p in posts:
-                if str(p["timestamp"]) == str(msg.get("POST_TIMESTAMP")) and p["user_id"] == msg.get("TO"):
-                    post_content = p["content"]
-                    break
-            
-            if msg.get("ACTION") == "LIKE":
-                if post_content:
-                    print_non_verbose(f"{liker} likes your post [{post_content}]")
-                else:
-                    print_non_verbose(f"{liker} likes your post")
-            elif msg.get("ACTION") == "UNLIKE":
-                if post_content:
-                    print_non_verbose(f"{liker} unlikes your post [{post_content}]")
-                else:
-                    print_non_verbose(f"{liker} unlikes your post")
+        sender_id = sender_raw.decode("utf-8", errors="ignore") if sender_raw else None
+        if sender_id:
+            seen_peer(sender_id, addr)  # Liveness and unicast address, for every datagram
 
+        if raw_msg.startswith(BUNDLE_PREFIX):
+            for part in split_bundle(raw_msg):
+                handle_message(part, addr)  # Each message gets every check below
+            return
 
-        elif msg_type == "GROUP_CREATE":
-            try:
-                members = [m.strip() for m in msg.get("MEMBERS", "").split(",") if m.strip()]
-                creator = msg.get("FROM")
-                
-                
-                if creator not in members:
-                    members.append(creator)
-                    
-                
-                with storage_lock:
-                    groups[msg.get("GROUP_ID")] = {
-                        "name": msg.get("GROUP_NAME"),
-                        "creator": creator,
-                        "members": members
-                    }
-                    
-                print(f"DEBUG: Stored group {msg.get('GROUP_ID')} with members {members}")
-                print_non_verbose(f"Group '{msg.get('GROUP_NAME')}' created by {creator} with members: {', '.join(members)}")
-                print_non_verbose(f"You've been added to {msg.get('GROUP_NAME')}")
-            except Exception as e:
-                log(f"Group creation failed: {e}")
-    
-        elif msg_type == "GROUP_UPDATE":
-            group_id = msg.get("GROUP_ID")
-            if group_id in groups:
-                # Update membership
-                add_members = [m for m in msg.get("ADD", "").split(",") if m] if msg.get("ADD") else []
-                remove_members = [m for m in msg.get("REMOVE", "").split(",") if m] if msg.get("REMOVE") else []
-                
-                
-                groups[group_id]["members"].extend(add_members)
-                
-                
-                for r in remove_members:
-                    if r in groups[group_id]["members"]:
-                        groups[group_id]["members"].remove(r)
-                
-               
-                group_name = groups[group_id]["name"]
-                print_non_verbose(f"The group '{group_name}' member list was updated.")
-            else:
-                log(f"GROUP_UPDATE: Unknown group {group_id}")
+        to = peek_field(raw_msg, "TO")
+        if to is not None and to != _USER_ID_BYTES:
+            return  # Addressed to someone else
 
-        # GROUP_MESSAGE
-        elif msg_type == "GROUP_MESSAGE":
-            group_id = msg.get("GROUP_ID")
-            print(f"DEBUG: Checking group {group_id} in {groups.keys()}")
-            print(f"DEBUG: Our USER_ID is {USER_ID}")
-            
-            if group_id in groups and USER_ID in groups[group_id]["members"]:
-                sender = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
-                group_name = groups[group_id]["name"]
-                print_non_verbose(f"[GROUP:{group_name}] {sender}: {msg.get('CONTENT')}")
-            else:
-                log(f"GROUP_MESSAGE: Not a member of {group_id}")
+        # Same datagram via another interface, a retransmit or a replay
+        msg_id = peek_field(raw_msg, "MESSAGE_ID")
+        if msg_id is not None and seen_messages.check_and_add((sender_raw, msg_id)):
+            log(f"Dropping duplicate message {msg_id.decode('utf-8', errors='ignore')}")
+            return
 
-        
-        elif msg_type == "TICTACTOE_INVITE":
-            from tictactoe import handle_tictactoe_invite
-            handle_tictactoe_invite(msg, sender_id)
-            
-        elif msg_type == "TICTACTOE_MOVE":
-            from tictactoe import handle_tictactoe_move
-            handle_tictactoe_move(msg, sender_id)
-            
-        elif msg_type == "TICTACTOE_RESULT":
-            from tictactoe import handle_tictactoe_result
-            handle_tictactoe_result(msg, sender_id)
-            
-        elif msg_type == "FILE_OFFER":
-            if msg.get("TO") == USER_ID:
-                fileid = msg.get("FILEID")
-                with storage_lock:
-                    # Skip if already processing
-                    if fileid in incoming_files:
-                        return
-                    
-                    
-                    incoming_files[fileid] = {
-                        "from": msg.get("FROM"),
-                        "filename": msg.get("FILENAME"),
-                        "filesize": msg.get("FILESIZE"),
-                        "filetype": msg.get("FILETYPE"),
-                        "description": msg.get("DESCRIPTION", ""),
-                        "timestamp": time.time(),
-                        "chunks": {},
-                        "received_chunks": set(),
-                        "total_chunks": None,
-                        "accepted": False  
-                    }
-                
-                display_name = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
-                print_non_verbose(f"User {display_name} is sending you a file. Do you accept? (Type 'accept {fileid}')")
-                
-        # FILE_CHUNK
-        elif msg_type == "FILE_CHUNK":
-            fileid = msg.get("FILEID")
-            print(f"DEBUG: Received chunk for fileid: {fileid}")
-            with storage_lock:
-                
-                if fileid not in incoming_files:
-                    log(f"Ignoring chunk for unaccepted file: {fileid}")
-                    return
-                
-                file_rec = incoming_files[fileid]
-                
-                
-                if not file_rec.get("accepted", False):
-                    log(f"Ignoring chunk for unaccepted file: {fileid}")
-                    return
-                
-                idx = int(msg.get("CHUNK_INDEX"))
-                total = int(msg.get("TOTAL_CHUNKS"))
-                
-                # Initialize if first chunk
-                if file_rec["total_chunks"] is None:
-                    file_rec["total_chunks"] = total
-                elif file_rec["total_chunks"] != total:
-                    log("Total chunks mismatch")
-                    return
-                
-              
-                file_rec["chunks"][idx] = msg.get("DATA")
-                file_rec["received_chunks"].add(idx)
-                
-                log(f"Received chunk {idx+1}/{total} for {file_rec['filename']}")
-                
-               
-                if len(file_rec["received_chunks"]) == total:
-                    threading.Thread(target=reassemble_file, args=(fileid,)).start()
+        type_raw = peek_field(raw_msg, "TYPE") or b""
+        msg_type = type_raw.decode("utf-8", errors="ignore")
+        handler = handlers.get(msg_type)
+        if handler is None:
+            log(f"No handler for message type {msg_type}")
+            return
 
-        # FILE_RECEIVED
-        elif msg_type == "FILE_RECEIVED":
-            
-            log(f"File {msg.get('FILEID')} received by {msg.get('FROM')}")
+        # Expired, revoked or wrong-scope tokens are dropped before parsing
+        reason = check_token(peek_field(raw_msg, "TOKEN"), type_raw, sender_raw)
+        if reason is not None:
+            log(f"Dropping {msg_type} from {sender_id}: {reason}")
+            return
+
+        handler(parse_bytes(raw_msg), sender_id)
 
     except Exception as e:
         log(f"Error parsing message: {e}")
 
-def periodic_broadcast():
-    """Sends PING and PROFILE every 10 seconds."""
-    while True:
-        ping_msg = build_message({"TYPE": "PING", "USER_ID": USER_ID})
-        send_broadcast(ping_msg)
-
-        profile_msg = build_message({
-            "TYPE": "PROFILE",
-            "USER_ID": USER_ID,
-            "DISPLAY_NAME": DISPLAY_NAME,
-            "STATUS": STATUS
-        })
-
+@register("POST")
+def handle_post(msg, sender_id):
+    ttl = int(msg.get("TTL", TTL_DEFAULT))
+    timestamp = msg.get("TIMESTAMP")
+    if timestamp is None:
+        # Older peers omit TIMESTAMP; their token expiry is issue time + TTL
+        try:
+            timestamp = int(msg.get("TOKEN", "").split("|")[1]) - ttl
+        except (IndexError, ValueError):
+            timestamp = int(time.time())
+    add_post(sender_id, msg.get("CONTENT", ""), int(timestamp), ttl)
+    display_name = peers.get(sender_id, {}).get("display_name", sender_id)
+    print_non_verbose(f"[POST] {display_name}: {msg.get('CONTENT')}")
+
+@register("DM")
+def handle_dm(msg, sender_id):
+    add_dm({"from": msg.get("FROM"), "to": msg.get("TO"), "content": msg.get("CONTENT"), "received": time.time()})
+    sender = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
+    print_non_verbose(f"[DM] {sender}: {msg.get('CONTENT')}")
+
+@register("FOLLOW")
+def handle_follow(msg, sender_id):
+    add_follower(sender_id)
+    print_non_verbose(f"User {sender_id} has followed you")
+
+@register("UNFOLLOW")
+def handle_unfollow(msg, sender_id):
+    remove_follower(sender_id)
+    print_non_verbose(f"User {sender_id} has unfollowed you")
+
+@register("LIKE")
+def handle_like(msg, sender_id):
+    add_like({"from": msg.get("FROM"), "to": msg.get("TO"), "post_timestamp": msg.get("POST_TIMESTAMP"), "action": msg.get("ACTION")})
+    liker = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
+
+    record_like(msg.get("TO"), msg.get("POST_TIMESTAMP"), msg.get("FROM"), msg.get("ACTION"))
+    post = find_post(msg.get("TO"), msg.get("POST_TIMESTAMP"))
+    post_content = post["content"] if post else None
+
+    if msg.get("ACTION") == "LIKE":
+        if post_content:
+            print_non_verbose(f"{liker} likes your post [{post_content}]")
+        else:
+            print_non_verbose(f"{liker} likes your post")
+    elif msg.get("ACTION") == "UNLIKE":
+        if post_content:
+            print_non_verbose(f"{liker} unlikes your post [{post_content}]")
+        else:
+            print_non_verbose(f"{liker} unlikes your post")
+
+@register("GROUP_CREATE")
+def handle_group_create(msg, sender_id):
+    try:
+        members = [m.strip() for m in msg.get("MEMBERS", "").split(",") if m.strip()]
+        creator = msg.get("FROM")
+        
+        
+        if creator not in members:
+            members.append(creator)
+            
         
-        send_broadcast(profile_msg)
-        time.sleep(10)  
+        set_group(msg.get("GROUP_ID"), {
+            "name": msg.get("GROUP_NAME"),
+            "creator": creator,
+            "members": members
+        })
+            
+        print(f"DEBUG: Stored group {msg.get('GROUP_ID')} with members {members}")
+        print_non_verbose(f"Group '{msg.get('GROUP_NAME')}' created by {creator} with members: {', '.join(members)}")
+        print_non_verbose(f"You've been added to {msg.get('GROUP_NAME')}")
+    except Exception as e:
+        log(f"Group creation failed: {e}")
+
+@register("GROUP_UPDATE")
+def handle_group_update(msg, sender_id):
+    group_id = msg.get("GROUP_ID")
+    # Update membership
+    add_members = [m for m in msg.get("ADD", "").split(",") if m] if msg.get("ADD") else []
+    remove_members = [m for m in msg.get("REMOVE", "").split(",") if m] if msg.get("REMOVE") else []
+    group = update_group_members(group_id, add_members, remove_members)
+    if group is not None:
+        group_name = group["name"]
+        print_non_verbose(f"The group '{group_name}' member list was updated.")
+    else:
+        log(f"GROUP_UPDATE: Unknown group {group_id}")
+
+@register("GROUP_MESSAGE")
+def handle_group_message(msg, sender_id):
+    group_id = msg.get("GROUP_ID")
+    groups = groups_view()
+    print(f"DEBUG: Checking group {group_id} in {groups.keys()}")
+    print(f"DEBUG: Our USER_ID is {USER_ID}")
+    
+    if group_id in groups and USER_ID in groups[group_id]["members"]:
+        sender = peers.get(msg.get("FROM"), {}).get("display_name", msg.get("FROM"))
+        group_name = groups[group_id]["name"]
+        print_non_verbose(f"[GROUP:{group_name}] {sender}: {msg.get('CONTENT')}")
+    else:
+        log(f"GROUP_MESSAGE: Not a member of {group_id}")
 
 def send_post(content: str):
     message_id = hex(random.getrandbits(64))[2:]
@@ -244,10 +174,12 @@ def send_post(content: str):
         "USER_ID": USER_ID,
         "CONTENT": content,
         "TTL": TTL_DEFAULT,
+        "TIMESTAMP": timestamp,
         "MESSAGE_ID": message_id,
         "TOKEN": token
     })
     send_broadcast(post_msg)
+    add_post(USER_ID, content, timestamp, TTL_DEFAULT)  # So LIKEs for it can show the content
     log(f"POST SENT: {content}")
 
 def send_dm(target_user: str, content: str):
@@ -263,7 +195,7 @@ def send_dm(target_user: str, content: str):
         "MESSAGE_ID": message_id,
         "TOKEN": token
     })
-    send_broadcast(dm_msg)
+    send_to(target_user, dm_msg)
     log(f"DM SENT to {target_user}: {content}")
 
 def send_follow(target_user: str):
@@ -314,10 +246,11 @@ def send_like(target_user: str, post_timestamp: int, action: str = "LIKE"):
         "MESSAGE_ID": message_id,
         "TOKEN": token
     })
-    send_broadcast(like_msg)
+    send_to(target_user, like_msg)
+    record_like(target_user, post_timestamp, USER_ID, action)
     
     
-    likes.append({
+    add_like({
         "from": USER_ID,
         "to": target_user,
         "post_timestamp": post_timestamp,
@@ -327,169 +260,16 @@ def send_like(target_user: str, post_timestamp: int, action: str = "LIKE"):
     
     log(f"{action} SENT to {target_user} for post at {post_timestamp}")
 
-def reassemble_file(fileid: str):
-    with storage_lock:
-        if fileid not in incoming_files:
-            return
-        file_rec = incoming_files.pop(fileid)
+def expire_storage():
+    """Apply retention limits and expire peers we no longer hear from"""
+    for uid in sweep():
+        log(f"Peer {uid} expired")
 
-    try:
-      
-        data = b""
-        for i in range(file_rec["total_chunks"]):
-            chunk = file_rec["chunks"].get(i)
-            if not chunk:
-                raise ValueError(f"Missing chunk {i}")
-            data += base64.b64decode(chunk)
-        
-      
-        filename = file_rec["filename"]
-        os.makedirs("received_files", exist_ok=True)
-        path = os.path.join("received_files", filename)
-        
-       
-        counter = 1
-        base_name, ext = os.path.splitext(filename)
-        while os.path.exists(path):
-            path = os.path.join("received_files", f"{base_name}_{counter}{ext}")
-            counter += 1
-            
-        with open(path, "wb") as f:
-            f.write(data)
-            
-        print_non_verbose(f"File transfer of {filename} is complete")
-        
-        
-        timestamp = int(time.time())
-        msg_id = hex(random.getrandbits(64))[2:]
-        token = f"{USER_ID}|{timestamp+TTL_DEFAULT}|file"
-        received_msg = build_message({
-            "TYPE": "FILE_RECEIVED",
-            "FROM": USER_ID,
-            "TO": file_rec["from"],
-            "FILEID": fileid,
-            "STATUS": "COMPLETE",
-            "TIMESTAMP": timestamp,
-            "MESSAGE_ID": msg_id,
-            "TOKEN": token
-        })
-        send_broadcast(received_msg)
-        
-    except Exception as e:
-        log(f"File reassembly failed: {e}")
-
-def cleanup_incoming_files():
-    """Remove unaccepted file entries after timeout"""
-    while True:
-        time.sleep(60)  
-        with storage_lock:
-            current_time = time.time()
-            expired = []
-            for fileid, file_rec in incoming_files.items():
-                
-                if not file_rec["received_chunks"] and current_time - file_rec["timestamp"] > 300:
-                    expired.append(fileid)
-            
-            for fileid in expired:
-                incoming_files.pop(fileid)
-                log(f"Expired file offer: {fileid}")
-
-
-
-
-
-
-def send_file(target: str, file_path: str, description: str = ""):
-    try:
-        import os
-        
-        # Debug information
-        print(f"DEBUG: Current directory: {os.getcwd()}")
-        print(f"DEBUG: Looking for file: '{file_path}'")
-        print(f"DEBUG: Full path: '{os.path.abspath(file_path)}'")
-        print(f"DEBUG: File exists: {os.path.exists(file_path)}")
-        
-        
-        target_dir = os.path.dirname(file_path) if os.path.dirname(file_path) else "."
-        print(f"DEBUG: Files in directory '{target_dir}':")
-        try:
-            for file in os.listdir(target_dir):
-                if os.path.isfile(os.path.join(target_dir, file)):
-                    full_path = os.path.join(target_dir, file)
-                    size = os.path.getsize(full_path)
-                    print(f"  - {file} ({size} bytes)")
-        except Exception as e:
-            print(f"  Error listing directory: {e}")
-        
-        if not os.path.exists(file_path):
-            print("File not found")
-            return
+def start_timers():
+    """Register the recurring jobs; per-file and per-game timeouts arm themselves."""
+    call_every(config.PRESENCE_INTERVAL, heartbeat)  # heartbeat returns its own next delay
+    call_every(STORAGE_SWEEP_INTERVAL, expire_storage, first=STORAGE_SWEEP_INTERVAL)
 
-        filename = os.path.basename(file_path)
-        filesize = os.path.getsize(file_path)
-        fileid = hex(random.getrandbits(128))[2:]
-        
-        print(f"DEBUG: File found! Size: {filesize} bytes")
-        
-      
-        timestamp = int(time.time())
-        msg_id = hex(random.getrandbits(64))[2:]
-        token = f"{USER_ID}|{timestamp+TTL_DEFAULT}|file"
-        offer_msg = build_message({
-            "TYPE": "FILE_OFFER",
-            "FROM": USER_ID,
-            "TO": target,
-            "FILENAME": filename,
-            "FILESIZE": filesize,
-            "FILETYPE": "application/octet-stream",
-            "FILEID": fileid,
-            "DESCRIPTION": description,
-            "TIMESTAMP": timestamp,
-            "MESSAGE_ID": msg_id,
-            "TOKEN": token
-        })
-        send_broadcast(offer_msg)
-        print(f"File offer sent for {filename}. DEBUG: Waiting 20 seconds for acceptance...")
-
-        time.sleep(20) 
-        
-        # Read and chunk file
-        CHUNK_SIZE = 45000  # ~60KB after base64
-        chunks = []
-        with open(file_path, "rb") as f:
-            while chunk := f.read(CHUNK_SIZE):
-                chunks.append(base64.b64encode(chunk).decode())
-        
-        total_chunks = len(chunks)
-        print(f"DEBUG: File split into {total_chunks} chunks")
-        
-   
-        for idx, data in enumerate(chunks):
-            timestamp = int(time.time())
-            msg_id = hex(random.getrandbits(64))[2:]
-            token = f"{USER_ID}|{timestamp+TTL_DEFAULT}|file"
-            chunk_msg = build_message({
-                "TYPE": "FILE_CHUNK",
-                "FROM": USER_ID,
-                "TO": target,
-                "FILEID": fileid,
-                "CHUNK_INDEX": idx,
-                "TOTAL_CHUNKS": total_chunks,
-                "CHUNK_SIZE": len(data),
-                "DATA": data,
-                "TIMESTAMP": timestamp,
-                "MESSAGE_ID": msg_id,
-                "TOKEN": token
-            })
-            send_broadcast(chunk_msg)
-            time.sleep(0.1)  # Prevent flooding
-            
-        print(f"Sent {filename} in {total_chunks} chunks")
-        
-    except Exception as e:
-        print(f"File send failed: {e}")
-        import traceback
-        traceback.print_exc()
 
 def send_group_create(group_name: str, members: str):
     """Create a new group with specified members"""
@@ -500,12 +280,11 @@ def send_group_create(group_name: str, members: str):
         # Include ourselves in te members list
         member_list = [USER_ID] + [m.strip() for m in members.split(",") if m.strip()]
 
-        with storage_lock:
-            groups[group_id] = {
-                "name": group_name,
-                "creator": USER_ID,
-                "members": member_list
-            }
+        set_group(group_id, {
+            "name": group_name,
+            "creator": USER_ID,
+            "members": member_list
+        })
         
         timestamp = int(time.time())
         message_id = hex(random.getrandbits(64))[2:]
@@ -532,8 +311,9 @@ def send_group_message(group_id: str, message: str):
     """Send a message to a group"""
     try:
         # Check if we're a member of this group
-        print(f"DEBUG: Checking membership for {USER_ID} in {groups[group_id]['members']}")
-        if group_id not in groups or USER_ID not in groups[group_id]["members"]:
+        group = groups_view().get(group_id)
+        print(f"DEBUG: Checking membership for {USER_ID} in {group['members'] if group else ()}")
+        if group is None or USER_ID not in group["members"]:
             print("You're not a member of this group")
             return
 
@@ -562,9 +342,18 @@ def send_group_message(group_id: str, message: str):
         raise
 
 if __name__ == "__main__":
-    threading.Thread(target=listen, args=(handle_message,), daemon=True).start()
-    threading.Thread(target=periodic_broadcast, daemon=True).start()
-    threading.Thread(target=cleanup_incoming_files, daemon=True).start()
+    if config.PERSIST_PATH:
+        restored = open_store(config.PERSIST_PATH, config.PERSIST_FLUSH_INTERVAL)
+        print("Restored " + ", ".join(f"{n} {name}" for name, n in restored.items()))
+
+    start_timers()
+    if config.RUNTIME == "asyncio":
+        from async_peer import AsyncPeer
+        AsyncPeer(handle_message, schedulers=[timers, scheduler]).start()
+    else:
+        threading.Thread(target=listen, args=(handle_message,), daemon=True).start()
+        threading.Thread(target=timers.run, name="lsnp-timers", daemon=True).start()
+        threading.Thread(target=scheduler.run, name="lsnp-transfers", daemon=True).start()
 
     print("LSNP Peer started.")
     print("Commands: list, post <msg>, dm <user_id> <msg>, follow <user_id>, unfollow <user_id>, posts, dms, followers, verbose, exit, send_file <user_id> <file_path> [description], like <user_id> <post_timestamp>, unlike <user_id> <post_timestamp>, accept <fileid>")
@@ -573,9 +362,10 @@ if __name__ == "__main__":
         cmd = input("> ").strip()
 
         if cmd == "list":
-            print("Known Peers:")
-            for uid, data in peers.items():
-                print(f" - {data['display_name']} ({uid}): {data['status']}")
+            print(f"Known Peers ({len(online_peers())} online):")
+            for uid, data in peers_view():
+                stale = " [stale]" if data["state"] != "online" else ""
+                print(f" - {data['display_name']} ({uid}): {data['status']}{stale}")
 
         elif cmd.startswith("post "):
             send_post(cmd[5:].strip())
@@ -607,25 +397,26 @@ if __name__ == "__main__":
 
         elif cmd == "posts":
             print("All Posts:")
-            for p in posts:
+            for p in posts_view():
                 name = peers.get(p["user_id"], {}).get("display_name", p["user_id"])
-                print(f" - {name}: {p['content']}")
+                count = like_count(p["user_id"], p["timestamp"])
+                print(f" - {name} [{p['timestamp']}]: {p['content']}" + (f" ({count} likes)" if count else ""))
 
         elif cmd == "dms":
             print("All DMs:")
-            for m in dms:
+            for m in dms_view():
                 sender = peers.get(m["from"], {}).get("display_name", m["from"])
                 print(f" - {sender}: {m['content']}")
 
         elif cmd == "followers":
             print("Followers:")
-            for f in followers:
+            for f in followers_view():
                 name = peers.get(f, {}).get("display_name", f)
                 print(f" - {name}")
 
         elif cmd == "groups":
             print("Groups:")
-            for gid, gdata in groups.items():
+            for gid, gdata in groups_view().items():
                 if USER_ID in gdata["members"]:
                     print(f" - {gdata['name']} ({gid}): {', '.join(gdata['members'])}")
         
@@ -669,28 +460,67 @@ if __name__ == "__main__":
         
         elif cmd.startswith("accept "):
             fileid = cmd.split(" ", 1)[1]
-            with storage_lock:
-                if fileid in incoming_files:
-                    incoming_files[fileid]["accepted"] = True
-                    incoming_files[fileid]["timestamp"] = time.time()
-                    print(f"Accepting file transfer: {incoming_files[fileid]['filename']}")
-                else:
-                    print("File offer not found or expired")
+            file_rec = accept_file(fileid)
+            if file_rec is not None:
+                print(f"Accepting file transfer: {file_rec.filename}")
+            else:
+                print("File offer not found or expired")
+
+        elif cmd.startswith("resume "):
+            fileid = cmd.split(" ", 1)[1]
+            file_rec = resume_file(fileid)
+            if file_rec is not None:
+                print(f"Requested missing chunks of {file_rec.filename} ({file_rec.received_count}/{file_rec.total_chunks} received)")
+            else:
+                print("No accepted transfer with that id")
+
+        elif cmd.startswith("reject "):
+            fileid = cmd.split(" ", 1)[1]
+            file_rec = reject_file(fileid)
+            if file_rec is not None:
+                print(f"Rejected file transfer: {file_rec.filename}")
+            else:
+                print("File offer not found or expired")
+
+        elif cmd.startswith("status "):
+            set_status(cmd[7:].strip())
+            print("Status updated")
+
+        elif cmd == "stats":
+            usage = stats()
+            print("Storage (entries, approx. bytes):")
+            for name in ("posts", "post_likes", "dms", "likes", "peers"):
+                count, nbytes = usage[name]
+                print(f" - {name}: {count} ({nbytes // 1024} KB)")
+            print("Evicted so far: " + ", ".join(f"{k} {v}" for k, v in usage["evicted"].items()))
+            print(f"Coalesced: {coalescer.bundled} messages in {coalescer.frames} datagrams")
+            print(f"Duplicates dropped: {seen_messages.duplicates}")
+            if network.pipeline is not None:  # Threads runtime only
+                print(f"Shed under load: {network.pipeline.dropped} datagrams")
+
+        elif cmd == "transfers":
+            list_transfers()
 
         elif cmd.startswith("send_file "):
             parts = cmd.split(" ", 2)
             if len(parts) < 3:
                 print("Usage: send_file <user> <filepath> [description]")
             else:
-                threading.Thread(
-                    target=send_file,
-                    args=(parts[1], parts[2], parts[3] if len(parts)>3 else ""),
-                    daemon=True
-                ).start()
+                # Queued on the shared scheduler; this returns as soon as the file is registered
+                send_file(parts[1], parts[2], parts[3] if len(parts)>3 else "")
+
+        elif cmd.startswith("priority "):
+            try:
+                _, fileid, priority = cmd.split(" ", 2)
+                if scheduler.set_priority(fileid, int(priority)):
+                    print(f"Priority of {fileid} set to {max(1, int(priority))}")
+                else:
+                    print("No outgoing transfer with that id")
+            except ValueError:
+                print("Usage: priority <fileid> <weight>")
         elif cmd.startswith("ttt_invite "):
             try:
                 _, target_user = cmd.split(" ", 1)
-                from tictactoe import send_tictactoe_invite
                 send_tictactoe_invite(target_user.strip())
             except ValueError:
                 print("Usage: ttt_invite <user_id>")
@@ -700,7 +530,6 @@ if __name__ == "__main__":
                 parts = cmd.split(" ")
                 game_id = parts[1]
                 position = int(parts[2])
-                from tictactoe import send_tictactoe_move
                 send_tictactoe_move(game_id, position)
             except (ValueError, IndexError):
                 print("Usage: ttt_move <game_id> <position>")
@@ -710,9 +539,12 @@ if __name__ == "__main__":
                 print("6 | 7 | 8")
         
         elif cmd == "ttt_games":
-            from tictactoe import list_active_games
             list_active_games()
         
         elif cmd == "exit":
             print("Exiting LSNP peer...")
+            leave()
+            coalescer.flush()  # Nothing left waiting for its window
+            sender.close()
+            close_store()
             break
\ No newline at end of file
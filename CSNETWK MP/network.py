@@ -1,21 +1,338 @@
 # network.py
 import socket
+import threading
+from collections import deque
+import config
 from config import BROADCAST_IP, PORT, BUFFER_SIZE
 from logger import log
+from parser import peek_field
+from storage import peer_address, peers_at, peer_supports, online_peers
+from timers import call_later
 
-def send_broadcast(message: str):
-    """Send UDP broadcast message."""
-    log(f"SEND >\n{message}")
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        s.sendto(message.encode("utf-8"), (BROADCAST_IP, PORT))
+class Sender:
+    """Long-lived UDP sender that owns one broadcast-enabled socket."""
+
+    def __init__(self):
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def _socket(self):
+        # Created on first use so importing network never touches the OS
+        if self._sock is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self._sock = s
+        return self._sock
+
+    def send(self, message, addr=(BROADCAST_IP, PORT)):
+        """Send one message (str or bytes) to addr."""
+        data = message.encode("utf-8") if isinstance(message, str) else message
+        with self._lock:
+            self._socket().sendto(data, addr)
+
+    def send_many(self, messages, addr=(BROADCAST_IP, PORT)):
+        """Send several messages to addr while holding the socket once."""
+        with self._lock:
+            s = self._socket()
+            for message in messages:
+                data = message.encode("utf-8") if isinstance(message, str) else message
+                s.sendto(data, addr)
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+sender = Sender()  # Shared by every module that sends
+
+BROADCAST_ADDR = (BROADCAST_IP, PORT)
+BUNDLE_PREFIX = b"TYPE: BUNDLE\n"
+MAX_BUNDLE_PARTS = 256
+
+def _bundle_header(messages) -> bytes:
+    lengths = ",".join(str(len(m)) for m in messages)
+    return f"TYPE: BUNDLE\nUSER_ID: {config.USER_ID}\nLENGTHS: {lengths}\n\n".encode("utf-8")
+
+def _frame_size(messages) -> int:
+    return len(_bundle_header(messages)) + sum(map(len, messages))
+
+def build_bundle(messages) -> bytes:
+    """Frame several encoded messages as one BUNDLE datagram.
+
+    The header lists each message's length, so messages are split exactly
+    even if they end in a binary body.
+    """
+    return _bundle_header(messages) + b"".join(messages)
+
+def split_bundle(data: bytes) -> list:
+    """The messages framed in a BUNDLE datagram; a malformed frame yields none."""
+    header_end = data.find(b"\n\n")
+    lengths = peek_field(data[:header_end], "LENGTHS") if header_end >= 0 else None
+    if not lengths:
+        return []
+    try:
+        sizes = [int(n) for n in lengths.split(b",")]
+    except ValueError:
+        return []
+    pos = header_end + 2
+    if len(sizes) > MAX_BUNDLE_PARTS or min(sizes) <= 0 or pos + sum(sizes) != len(data):
+        return []
+    parts = []
+    for n in sizes:
+        part = data[pos:pos + n]
+        pos += n
+        if not part.startswith(BUNDLE_PREFIX):  # No bundles inside bundles
+            parts.append(part)
+    return parts
+
+class Coalescer:
+    """Holds small outgoing messages for up to BUNDLE_WINDOW so several share a datagram.
+
+    Messages wait per destination address and go out as one BUNDLE frame when
+    the window closes or the next one would push the frame past
+    BUNDLE_MAX_BYTES. A lone message is sent as is.
+    """
+
+    def __init__(self, sender: Sender):
+        self.sender = sender
+        self.bundled = 0  # Messages that shared a datagram
+        self.frames = 0   # BUNDLE datagrams sent
+        self._pending = {}  # {addr: [encoded message, ...]}
+        self._lock = threading.Lock()
+
+    def bundleable(self, message) -> bool:
+        """True for small messages of the BUNDLE_TYPES, when coalescing is on."""
+        # Anything over half a frame could rarely share one, so it isn't held back
+        if config.BUNDLE_WINDOW <= 0 or len(message) > config.BUNDLE_MAX_BYTES // 2:
+            return False
+        msg_type = peek_field(message, "TYPE")
+        if isinstance(msg_type, (bytes, bytearray)):
+            msg_type = msg_type.decode("utf-8", errors="ignore")
+        return msg_type in config.BUNDLE_TYPES
+
+    def add(self, message, addr):
+        # Copied: senders may reuse their buffer as soon as we return
+        data = message.encode("utf-8") if isinstance(message, str) else bytes(message)
+        full = None
+        with self._lock:
+            queue = self._pending.get(addr)
+            if queue is not None and _frame_size(queue + [data]) > config.BUNDLE_MAX_BYTES:
+                full = self._pending.pop(addr)
+                queue = None
+            if queue is None:
+                queue = self._pending[addr] = []
+                call_later(config.BUNDLE_WINDOW, self.flush, addr)
+            queue.append(data)
+        if full is not None:
+            self._send(full, addr)
+
+    def flush(self, addr=None):
+        """Send whatever is waiting for addr (or for every address) now."""
+        with self._lock:
+            if addr is None:
+                pending, self._pending = self._pending, {}
+            else:
+                queue = self._pending.pop(addr, None)
+                pending = {addr: queue} if queue else {}
+        for dest, queue in pending.items():
+            self._send(queue, dest)
+
+    def _send(self, queue, addr):
+        if len(queue) == 1:
+            self.sender.send(queue[0], addr)
+            return
+        self.bundled += len(queue)
+        self.frames += 1
+        self.sender.send(build_bundle(queue), addr)
+
+coalescer = Coalescer(sender)
+
+def _all_bundle() -> bool:
+    """Broadcasts are bundled only when every peer we can see understands BUNDLE."""
+    peers = online_peers()
+    return bool(peers) and all(peer_supports(uid, "BUNDLE") for uid in peers)
+
+def _log_send(message, dest: str = ""):
+    # Skip formatting (and decoding 60 KB chunks) unless verbose output is on
+    if config.VERBOSE:
+        text = message if isinstance(message, str) else bytes(message).decode("utf-8", errors="ignore")
+        log(f"SEND >{dest}\n{text}")
+
+def send_broadcast(message):
+    """Send UDP broadcast message (str or bytes)."""
+    _log_send(message)
+    if coalescer.bundleable(message) and _all_bundle():
+        coalescer.add(message, BROADCAST_ADDR)
+        return
+    coalescer.flush(BROADCAST_ADDR)  # Anything already waiting goes out first
+    sender.send(message)
+
+def send_broadcast_many(messages):
+    """Send a batch of UDP broadcast messages over the shared socket."""
+    direct = []
+    bundle = None
+    for message in messages:
+        _log_send(message)
+        if coalescer.bundleable(message):
+            bundle = _all_bundle() if bundle is None else bundle
+            if bundle:
+                coalescer.add(message, BROADCAST_ADDR)
+                continue
+        direct.append(message)
+    if direct:
+        coalescer.flush(BROADCAST_ADDR)
+        sender.send_many(direct)
+
+_local_ips = None
+
+def local_ips() -> set:
+    """Addresses of this host; peers seen from them are other terminals on the same machine."""
+    global _local_ips
+    if _local_ips is None:
+        ips = {"0.0.0.0"}
+        try:
+            ips.update(socket.gethostbyname_ex(socket.gethostname())[2])
+        except OSError:
+            pass
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect(("10.255.255.255", PORT))  # Sends nothing; just picks the outgoing interface
+                ips.add(s.getsockname()[0])
+        except OSError:
+            pass
+        _local_ips = ips
+    return _local_ips
+
+def unicast_ip(user_id: str):
+    """Where to unicast to a peer, or None when only a broadcast reaches it reliably.
+
+    Peers on one host all bind PORT with SO_REUSEADDR, and a unicast
+    datagram is delivered to only one of those sockets. So a local address,
+    or one that several USER_IDs share, gets broadcast instead.
+    """
+    ip = peer_address(user_id)  # Kept current by storage's peer liveness table
+    if ip is None or ip.startswith("127.") or ip in local_ips() or peers_at(ip) > 1:
+        return None
+    return ip
+
+def send_to(user_id: str, message):
+    """Unicast a message addressed to one peer, or broadcast if we can't single it out."""
+    ip = unicast_ip(user_id)
+    if ip is None:
+        send_broadcast(message)
+        return
+    _log_send(message, f" {user_id} ({ip})")
+    # Peers send from ephemeral ports, so always target the LSNP listening port
+    addr = (ip, PORT)
+    if coalescer.bundleable(message) and peer_supports(user_id, "BUNDLE"):
+        coalescer.add(message, addr)
+        return
+    coalescer.flush(addr)
+    sender.send(message, addr)
+
+def peek_type(data: bytes) -> bytes:
+    """Return the raw TYPE value of a datagram without decoding or parsing it."""
+    return peek_field(data, "TYPE") or b""
+
+class _WorkerQueue:
+    """Bounded FIFO feeding one handler worker, with an overload policy."""
+
+    def __init__(self, maxsize: int, policy: str, shed_types):
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.shed_types = [t.encode() for t in shed_types]
+        self.dropped = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        """Queue (type, data, addr), shedding something first if we're full."""
+        with self._cond:
+            if len(self._items) >= self.maxsize and not self._make_room(item[0]):
+                self.dropped += 1
+                return
+            self._items.append(item)
+            self._cond.notify()
+
+    def _make_room(self, msg_type: bytes) -> bool:
+        """Drop one queued datagram; False means the incoming one should be dropped instead."""
+        if self.policy == "drop_by_type":
+            for shed in self.shed_types:
+                for i, queued in enumerate(self._items):
+                    if queued[0] == shed:
+                        del self._items[i]
+                        self.dropped += 1
+                        return True
+            if msg_type in self.shed_types:
+                return False
+        self._items.popleft()
+        self.dropped += 1
+        return True
+
+    def get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            return self._items.popleft()
+
+class ReceivePipeline:
+    """Fans received datagrams out to a pool of handler workers.
+
+    Datagrams are sharded by source IP, so everything from one sender is
+    handled by the same worker and stays in arrival order.
+    """
+
+    def __init__(self, callback, workers: int = None, queue_size: int = None, policy: str = None):
+        self.callback = callback
+        workers = config.RECV_WORKERS if workers is None else workers
+        queue_size = config.RECV_QUEUE_SIZE if queue_size is None else queue_size
+        policy = config.OVERLOAD_POLICY if policy is None else policy
+        self.queues = [_WorkerQueue(queue_size // max(1, workers), policy, config.SHED_TYPES)
+                       for _ in range(workers)]
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._worker, args=(q,), name=f"lsnp-worker-{i}", daemon=True).start()
+
+    def submit(self, data: bytes, addr):
+        if not self.queues:
+            self._handle(data, addr)
+            return
+        q = self.queues[hash(addr[0]) % len(self.queues)]
+        q.put((peek_type(data), data, addr))
+
+    @property
+    def dropped(self) -> int:
+        return sum(q.dropped for q in self.queues)
+
+    def _worker(self, q: _WorkerQueue):
+        while True:
+            _, data, addr = q.get()
+            self._handle(data, addr)
+
+    def _handle(self, data: bytes, addr):
+        try:
+            if config.VERBOSE:
+                log(f"RECV < {addr}\n{data.decode('utf-8', errors='ignore')}")
+            self.callback(data, addr)
+        except Exception as e:
+            log(f"Handler error for datagram from {addr}: {e}")
+
+pipeline = None  # The ReceivePipeline started by listen(), kept for its drop counter
+
+def listen(callback, workers: int = None):
+    """Listen for UDP messages and pass the raw bytes to a callback.
 
-def listen(callback):
-    """Listen for UDP messages and pass them to a callback."""
+    The receive loop only drains the socket; callbacks run on the worker
+    pool (config.RECV_WORKERS, or inline when that is 0).
+    """
+    global pipeline
+    pipeline = ReceivePipeline(callback, workers)
+    pipeline.start()
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(("", PORT))
         while True:
             data, addr = s.recvfrom(BUFFER_SIZE)
-            log(f"RECV < {addr}\n{data.decode(errors='ignore')}")
-            callback(data.decode("utf-8", errors="ignore"), addr)
\ No newline at end of file
+            pipeline.submit(data, addr)
\ No newline at end of file
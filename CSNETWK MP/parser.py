@@ -4,12 +4,126 @@ def build_message(fields: dict) -> str:
     """Build LSNP key-value formatted message."""
     return "\n".join(f"{k}: {v}" for k, v in fields.items()) + "\n\n"
 
-def parse_message(raw: str) -> dict:
-    """Parse LSNP key-value message into a dictionary."""
-    lines = [l.strip() for l in raw.strip().split("\n") if l.strip()]
-    msg = {}
-    for line in lines:
-        if ": " in line:
-            k, v = line.split(": ", 1)
-            msg[k.strip()] = v.strip()
-    return msg
\ No newline at end of file
+def peek_field(raw, key: str):
+    """Return one header field's value from a raw str/bytes message without parsing it, or None.
+
+    Only the header is searched: a binary body is file data and may contain
+    anything, including text that looks like a field.
+    """
+    nl = "\n"
+    if isinstance(raw, (bytes, bytearray)):
+        nl = b"\n"
+        key = key.encode()
+    needle = key + (": " if nl == "\n" else b": ")
+    header_end = raw.find(nl + nl)
+    if header_end < 0:
+        header_end = len(raw)
+    if raw.startswith(needle):
+        start = len(needle)
+    else:
+        i = raw.find(nl + needle, 0, header_end)
+        if i < 0:
+            return None
+        start = i + 1 + len(needle)
+    end = raw.find(nl, start, header_end)
+    return raw[start:end if end >= 0 else header_end].strip()
+
+_WHITESPACE = b" \t\r"
+
+class Message:
+    """LSNP message parsed lazily from the received bytes.
+
+    Field offsets are indexed once; values are decoded on first access and
+    raw() hands out memoryview slices, so large fields like DATA are never
+    copied unless a handler actually needs them as text. Anything after the
+    blank line that ends the header is the (binary) body.
+    """
+
+    __slots__ = ("_data", "_view", "_index", "_cache", "_body_start")
+
+    def __init__(self, data: bytes):
+        self._data = data
+        self._view = memoryview(data)
+        self._index = {}   # {key: (start, end)} into data
+        self._cache = {}   # {key: decoded str}
+        find = data.find
+        n = len(data)
+        header_end = find(b"\n\n")
+        if header_end >= 0:
+            self._body_start = header_end + 2
+            n = header_end
+        else:
+            self._body_start = len(data)
+        pos = 0
+        while pos < n:
+            end = find(b"\n", pos)
+            if end < 0:
+                end = n
+            sep = find(b": ", pos, end)
+            if sep >= 0:
+                start, stop = sep + 2, end
+                while start < stop and data[start] in _WHITESPACE:
+                    start += 1
+                while stop > start and data[stop - 1] in _WHITESPACE:
+                    stop -= 1
+                self._index[data[pos:sep].strip().decode("utf-8", errors="ignore")] = (start, stop)
+            pos = end + 1
+
+    def get(self, key: str, default=None):
+        if key in self._cache:
+            return self._cache[key]
+        span = self._index.get(key)
+        if span is None:
+            return default
+        value = self._data[span[0]:span[1]].decode("utf-8", errors="ignore")
+        self._cache[key] = value
+        return value
+
+    def raw(self, key: str):
+        """Zero-copy memoryview of a field's value, or None."""
+        span = self._index.get(key)
+        return self._view[span[0]:span[1]] if span is not None else None
+
+    def body(self):
+        """Zero-copy memoryview of the bytes after the header (empty for text messages)."""
+        return self._view[self._body_start:]
+
+    def __getitem__(self, key: str) -> str:
+        if key not in self._index:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+def parse_bytes(data: bytes) -> Message:
+    """Parse a received datagram into a lazily decoded Message."""
+    return Message(data)
+
+class MessageBuilder:
+    """Encodes LSNP messages into one reusable bytearray.
+
+    Values may be str, numbers or bytes-like; bytes are copied in without
+    decoding. An optional raw body follows the blank line that ends the
+    header. The returned buffer is overwritten by the next build(), so send
+    it before building again (one builder per sending thread).
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def build(self, fields: dict, body=None) -> bytearray:
+        buf = self._buf
+        del buf[:]
+        for k, v in fields.items():
+            buf += k.encode()
+            buf += b": "
+            buf += v if isinstance(v, (bytes, bytearray, memoryview)) else str(v).encode()
+            buf += b"\n"
+        buf += b"\n"
+        if body is not None:
+            buf += body
+        return buf
\ No newline at end of file
@@ -0,0 +1,84 @@
+# persistence.py
+import json
+import sqlite3
+import threading
+from logger import log
+
+class WriteBehindStore:
+    """SQLite copy of storage state, written behind the in-memory structures.
+
+    Handlers only record the latest value per (collection, key) in a dict;
+    a background thread writes whatever is pending in one transaction every
+    flush_interval seconds, so no handler ever waits on the disk.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 2.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS state (
+            collection TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (collection, key))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS state_order ON state (collection, seq)")
+        self._db.commit()
+        self._seq = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM state").fetchone()[0]
+        self._pending = {}  # {(collection, key): (seq, json) or None for a delete}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def put(self, collection: str, key: str, value):
+        """Queue an insert/update. The value is serialized now, so later mutation is safe."""
+        data = json.dumps(value)
+        with self._lock:
+            self._seq += 1
+            self._pending[(collection, key)] = (self._seq, data)
+
+    def delete(self, collection: str, key: str):
+        with self._lock:
+            self._pending[(collection, key)] = None
+
+    def load(self, collection: str):
+        """All (key, value) rows of a collection in the order they were last written."""
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT key, value FROM state WHERE collection = ? ORDER BY seq", (collection,)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        upserts = [(c, k, v[1], v[0]) for (c, k), v in pending.items() if v is not None]
+        deletes = [(c, k) for (c, k), v in pending.items() if v is None]
+        with self._db_lock:
+            try:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)", upserts)
+                    self._db.executemany("DELETE FROM state WHERE collection = ? AND key = ?", deletes)
+            except sqlite3.Error as e:
+                log(f"Persisting {len(pending)} changes failed, will retry: {e}")
+                with self._lock:
+                    # Put the batch back for the next flush; anything queued since is newer and wins
+                    for key, value in pending.items():
+                        self._pending.setdefault(key, value)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        threading.Thread(target=self._run, name="lsnp-persist", daemon=True).start()
+
+    def close(self):
+        """Write out anything pending and close the database."""
+        self._stopped.set()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
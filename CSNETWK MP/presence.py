@@ -0,0 +1,123 @@
+# presence.py
+import time
+import zlib
+import random
+import config
+from config import USER_ID
+from parser import build_message
+from network import send_broadcast, send_broadcast_many, send_to
+from logger import log, print_non_verbose
+from storage import peers, online_peers, update_peer, remove_peer
+from dispatch import register
+
+PRESENCE_JITTER = 0.25         # Heartbeats go out at interval * (1 +/- this)
+PROFILE_REQUEST_INTERVAL = 30  # Minimum seconds between PROFILE_REQUESTs to one peer
+
+# Our profile; change it with set_status so peers hear about it
+display_name = config.DISPLAY_NAME
+status = config.STATUS
+
+_last_profile_broadcast = 0.0
+_requested = {}  # {user_id: when we last asked it for its PROFILE}
+
+def profile_rev() -> str:
+    """Short hash of our profile, carried by every heartbeat."""
+    profile = f"{display_name}|{status}|{','.join(config.CAPABILITIES)}"
+    return format(zlib.crc32(profile.encode("utf-8")), "08x")
+
+def build_profile() -> str:
+    return build_message({
+        "TYPE": "PROFILE",
+        "USER_ID": USER_ID,
+        "DISPLAY_NAME": display_name,
+        "STATUS": status,
+        "CAPABILITIES": ",".join(config.CAPABILITIES),
+        "PROFILE_REV": profile_rev(),
+    })
+
+def send_profile(target: str = None):
+    """Broadcast our PROFILE, or unicast it to one peer."""
+    global _last_profile_broadcast
+    if target is not None:
+        send_to(target, build_profile())
+        return
+    send_broadcast(build_profile())
+    _last_profile_broadcast = time.time()
+
+def heartbeat_interval() -> float:
+    """Seconds until our next heartbeat.
+
+    The interval grows with the number of peers we can see, so the LAN as a
+    whole carries about PRESENCE_PEERS_PER_INTERVAL heartbeats per
+    PRESENCE_INTERVAL however many peers there are. Jitter keeps peers that
+    started together from sending in lockstep.
+    """
+    crowd = (len(online_peers()) + 1) / config.PRESENCE_PEERS_PER_INTERVAL
+    interval = min(config.PRESENCE_INTERVAL * max(1.0, crowd), config.PRESENCE_MAX_INTERVAL)
+    return interval * random.uniform(1 - PRESENCE_JITTER, 1 + PRESENCE_JITTER)
+
+def heartbeat() -> float:
+    """Send one heartbeat and return the delay until the next.
+
+    The heartbeat is a PING carrying PROFILE_REV, so peers only ask for our
+    PROFILE when it changed. A full PROFILE still goes out every
+    PROFILE_REFRESH_INTERVAL for older peers that never ask.
+    """
+    global _last_profile_broadcast
+    ping_msg = build_message({"TYPE": "PING", "USER_ID": USER_ID, "PROFILE_REV": profile_rev()})
+    if time.time() - _last_profile_broadcast >= config.PROFILE_REFRESH_INTERVAL:
+        send_broadcast_many([ping_msg, build_profile()])
+        _last_profile_broadcast = time.time()
+    else:
+        send_broadcast(ping_msg)
+    return heartbeat_interval()
+
+def set_status(new_status: str):
+    """Change our status and announce it right away."""
+    global status
+    status = new_status
+    send_profile()
+
+def leave():
+    """Tell peers we're going, so they drop us now instead of timing us out."""
+    send_broadcast(build_message({"TYPE": "LEAVE", "USER_ID": USER_ID}))
+
+def request_profile(user_id: str):
+    now = time.time()
+    if now - _requested.get(user_id, 0) < PROFILE_REQUEST_INTERVAL:
+        return
+    if len(_requested) > config.MAX_PEERS:
+        _requested.clear()
+    _requested[user_id] = now
+    send_to(user_id, build_message({"TYPE": "PROFILE_REQUEST", "FROM": USER_ID, "TO": user_id}))
+
+@register("PING")
+def handle_ping(msg, sender_id):
+    log(f"PING received from {sender_id}")
+    peer = peers.get(sender_id, {})  # handle_message already refreshed its liveness
+    rev = msg.get("PROFILE_REV")
+    if rev is not None and peer.get("profile_rev") != rev:
+        request_profile(sender_id)  # New to us, or its profile changed
+
+@register("PROFILE_REQUEST")
+def handle_profile_request(msg, sender_id):
+    send_profile(sender_id)
+
+@register("PROFILE")
+def handle_profile(msg, sender_id):
+    display = msg.get("DISPLAY_NAME", sender_id)
+    peer_status = msg.get("STATUS", "")
+    capabilities = {c for c in msg.get("CAPABILITIES", "").split(",") if c}
+    is_new = not peers.get(sender_id, {}).get("profiled")
+    if update_peer(sender_id, display, peer_status, capabilities, msg.get("PROFILE_REV")):
+        print_non_verbose(f"[PROFILE] {display} - {peer_status}")
+    if is_new:
+        # Introduce ourselves instead of making a newcomer wait for our next refresh
+        send_profile(sender_id)
+
+@register("LEAVE")
+def handle_leave(msg, sender_id):
+    peer = remove_peer(sender_id)
+    _requested.pop(sender_id, None)
+    if peer is not None:
+        print_non_verbose(f"{peer.get('display_name', sender_id)} has left")
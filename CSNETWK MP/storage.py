@@ -1,12 +1,470 @@
 # storage.py
+import sys
+import time
+import heapq
 import threading
+from collections import deque
+import config
 
-peers = {}      # {user_id: {"display_name": str, "status": str}}
-posts = []      # [{"user_id": str, "content": str, "timestamp": int}]
-dms = []        # [{"from": str, "to": str, "content": str}]
+peers = {}      # {user_id: {"display_name", "status", "capabilities", "addr", "last_seen", "state"}}
+online = set()  # user_ids whose state is "online"
+addr_peers = {} # {ip: {user_ids last heard from it}}; more than one means they share a host
+posts = deque() # [{"user_id": str, "content": str, "timestamp": int, "ttl": int, "received": float}] in arrival order, at most MAX_POSTS
+post_index = {} # {(user_id, str(timestamp)): latest post with that key} for constant-time lookups
+post_likes = {} # {(user_id, str(timestamp)): {liker user_ids}}, also for posts we haven't seen
+dms = deque(maxlen=config.MAX_DMS)  # [{"from": str, "to": str, "content": str, "received": float}]
 followers = set()  # {"alice@192.168.1.11", ...}
 groups = {}     # {group_id: {"name": str, "members": [user_ids]}}
-likes = []      # [{"from": str, "to": str, "post_timestamp": int, "action": "LIKE"}]
+likes = deque(maxlen=config.MAX_LIKES)  # [{"from": str, "to": str, "post_timestamp": int, "action": "LIKE"}]
+evicted = {"posts": 0, "post_likes": 0, "dms": 0, "peers": 0}  # Running totals dropped by retention
 
-storage_lock = threading.Lock()  # Lock for thread-safe access
-incoming_files = {} # {fileid: {"from": str, "filename": str, "filesize": int, "filetype": str, "description": str}}
\ No newline at end of file
+incoming_files = {} # {fileid: IncomingFile}
+outgoing_transfers = {} # {fileid: OutgoingFile} for sends in progress
+
+class ShardedLock:
+    """A fixed set of locks chosen by key, so work on different keys doesn't contend."""
+
+    def __init__(self, shards: int = 16):
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def for_key(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+class _Snapshot:
+    """Immutable copy of a collection for readers, rebuilt on the first read after a write.
+
+    build runs under the collection's lock; writers call invalidate() while
+    holding it, so a reader never sees a half-applied change.
+    """
+
+    def __init__(self, lock, build):
+        self._lock = lock
+        self._build = build
+        self._view = None
+
+    def invalidate(self):
+        self._view = None
+
+    def get(self):
+        view = self._view
+        if view is None:
+            with self._lock:
+                view = self._view = self._build()
+        return view
+
+# One lock per collection so unrelated handlers never wait on each other.
+# Plain reads of a single key (peers.get, post_index.get) need no lock.
+peers_lock = threading.Lock()
+posts_lock = threading.Lock()      # posts, post_index, post_likes and likes
+dms_lock = threading.Lock()
+followers_lock = threading.Lock()
+groups_lock = threading.Lock()
+incoming_locks = ShardedLock()     # incoming_files, per fileid
+transfers_lock = threading.Lock()  # outgoing_transfers
+_evicted_lock = threading.Lock()
+
+_online_view = _Snapshot(peers_lock, lambda: frozenset(online))
+_peers_view = _Snapshot(peers_lock, lambda: tuple((uid, dict(p)) for uid, p in peers.items()))
+_posts_view = _Snapshot(posts_lock, lambda: tuple(posts))
+_dms_view = _Snapshot(dms_lock, lambda: tuple(dms))
+_followers_view = _Snapshot(followers_lock, lambda: frozenset(followers))
+_groups_view = _Snapshot(groups_lock, lambda: {gid: dict(g, members=tuple(g["members"])) for gid, g in groups.items()})
+
+def peers_view():
+    """(user_id, record) pairs as of the last change; safe to iterate without locks."""
+    return _peers_view.get()
+
+def online_peers():
+    """user_ids heard from within PEER_STALE_AFTER; a cached frozenset."""
+    return _online_view.get()
+
+def posts_view():
+    return _posts_view.get()
+
+def dms_view():
+    return _dms_view.get()
+
+def followers_view():
+    return _followers_view.get()
+
+def groups_view():
+    """{group_id: record} with members as tuples."""
+    return _groups_view.get()
+
+def _count_evicted(name: str, n: int = 1):
+    with _evicted_lock:
+        evicted[name] += n
+
+store = None  # persistence.WriteBehindStore when config.PERSIST_PATH is set
+
+def _persist(collection: str, key: str, value):
+    if store is not None:
+        store.put(collection, key, value)
+
+def _unpersist(collection: str, key: str):
+    if store is not None:
+        store.delete(collection, key)
+
+def peer_supports(user_id: str, capability: str) -> bool:
+    """True if the peer advertised capability in its last PROFILE."""
+    return capability in peers.get(user_id, {}).get("capabilities", ())
+
+def _post_key(user_id: str, timestamp) -> tuple:
+    # LIKE carries the timestamp as text, so keys always use its string form
+    return (user_id, str(timestamp))
+
+def _post_row_key(post: dict) -> str:
+    # Several posts can share (user_id, timestamp); the receive time tells their rows apart
+    key = "|".join(_post_key(post["user_id"], post["timestamp"]))
+    received = post.get("received")
+    return key if received is None else f"{key}|{received:.6f}"
+
+def add_post(user_id: str, content: str, timestamp, ttl=None) -> dict:
+    """Store a post (ours or a peer's) and index it by (user_id, timestamp).
+
+    Every post is kept, even one sharing a second with an earlier post from
+    the same user; retransmits never get here (handle_message drops them by
+    MESSAGE_ID). The index points at the latest post for each key.
+    """
+    post = {"user_id": user_id, "content": content, "timestamp": timestamp, "ttl": ttl, "received": time.time()}
+    with posts_lock:
+        if len(posts) >= config.MAX_POSTS:
+            _drop_post(posts.popleft())
+        posts.append(post)
+        post_index[_post_key(user_id, timestamp)] = post
+        _posts_view.invalidate()
+    _persist("posts", _post_row_key(post), post)
+    return post
+
+def find_post(user_id: str, timestamp):
+    """The post user_id made at timestamp, or None."""
+    return post_index.get(_post_key(user_id, timestamp))
+
+def record_like(post_owner: str, post_timestamp, liker: str, action: str = "LIKE") -> int:
+    """Apply a LIKE/UNLIKE to a post's aggregate and return its like count."""
+    key = _post_key(post_owner, post_timestamp)
+    with posts_lock:
+        likers = post_likes.setdefault(key, set())
+        if action == "UNLIKE":
+            likers.discard(liker)
+        else:
+            likers.add(liker)
+        count = len(likers)
+        if not likers:
+            del post_likes[key]
+    return count
+
+def like_count(user_id: str, timestamp) -> int:
+    return len(post_likes.get(_post_key(user_id, timestamp), ()))
+
+def add_like(like: dict):
+    """Append to the LIKE/UNLIKE history."""
+    with posts_lock:
+        likes.append(like)
+
+
+def _drop_post(post: dict):
+    # Caller holds posts_lock
+    key = _post_key(post["user_id"], post["timestamp"])
+    _unpersist("posts", _post_row_key(post))
+    _count_evicted("posts")
+    if post_index.get(key) is not post:
+        return  # A later post with the same key is indexed; it keeps the likes
+    del post_index[key]
+    if post_likes.pop(key, None) is not None:
+        _count_evicted("post_likes")
+
+def sweep(now: float = None) -> list:
+    """Apply TTL expiry and capacity limits. Returns the user_ids of evicted peers."""
+    now = time.time() if now is None else now
+    with posts_lock:
+        # Posts live for their own TTL
+        alive = deque(p for p in posts if p["timestamp"] + (p["ttl"] or config.TTL_DEFAULT) > now)
+        if len(alive) != len(posts):
+            for p in posts:
+                if p["timestamp"] + (p["ttl"] or config.TTL_DEFAULT) <= now:
+                    _drop_post(p)
+            posts.clear()
+            posts.extend(alive)
+            _posts_view.invalidate()
+
+        # Like aggregates for posts we never received expire after the default TTL
+        for key in [k for k in post_likes if k not in post_index]:
+            try:
+                stale = int(key[1]) + config.TTL_DEFAULT <= now
+            except ValueError:
+                stale = True
+            if stale:
+                del post_likes[key]
+                _count_evicted("post_likes")
+
+    with dms_lock:
+        while dms and dms[0].get("received", now) + config.DM_RETENTION <= now:
+            _unpersist("dms", _dm_key(dms.popleft()))
+            _count_evicted("dms")
+            _dms_view.invalidate()
+
+    gone = expire_peers(now)
+    with peers_lock:
+        # Capacity limit: only sorts when we're actually over it
+        excess = len(peers) - config.MAX_PEERS
+        if excess > 0:
+            by_age = sorted((p["last_seen"], uid) for uid, p in peers.items())
+            for _, uid in by_age[:excess]:
+                _evict_peer(uid)
+                gone.append(uid)
+            _count_evicted("peers", excess)
+    return gone
+
+# Liveness: each peer has one entry here, the next time its last_seen needs
+# checking. Datagrams only bump last_seen; the heap is touched once per
+# PEER_STALE_AFTER per peer, when its entry comes due.
+_liveness = []     # heap of (deadline, user_id)
+_scheduled = set() # user_ids with an entry in _liveness
+
+def _schedule(user_id: str, deadline: float):
+    # Caller holds peers_lock
+    if user_id not in _scheduled:
+        _scheduled.add(user_id)
+        heapq.heappush(_liveness, (deadline, user_id))
+
+def _new_peer(user_id: str, now: float) -> dict:
+    # Caller holds peers_lock
+    peer = peers[user_id] = {"display_name": user_id, "status": "", "capabilities": set(),
+                             "addr": None, "last_seen": now, "state": "online"}
+    online.add(user_id)
+    _schedule(user_id, now + config.PEER_STALE_AFTER)
+    _online_view.invalidate()
+    return peer
+
+def _set_addr(user_id: str, peer: dict, ip):
+    # Caller holds peers_lock
+    old = peer.get("addr")
+    if old is not None and old != ip:
+        users = addr_peers.get(old)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del addr_peers[old]
+    peer["addr"] = ip
+    if ip is not None:
+        addr_peers.setdefault(ip, set()).add(user_id)
+
+def _evict_peer(user_id: str):
+    # Caller holds peers_lock
+    peer = peers.pop(user_id, None)
+    if peer is not None:
+        _set_addr(user_id, peer, None)
+    online.discard(user_id)
+    _online_view.invalidate()
+    _peers_view.invalidate()
+    _unpersist("peers", user_id)
+    return peer
+
+def seen_peer(user_id: str, addr=None) -> dict:
+    """Record a datagram from user_id at addr; called for every one we receive."""
+    now = time.time()
+    peer = peers.get(user_id)
+    ip = addr[0] if addr else None
+    if peer is not None and peer["state"] == "online" and (ip is None or peer["addr"] == ip):
+        peer["last_seen"] = now  # Common case: no lock, no heap work
+        return peer
+    with peers_lock:
+        peer = peers.get(user_id) or _new_peer(user_id, now)
+        peer["last_seen"] = now
+        if ip is not None:
+            _set_addr(user_id, peer, ip)
+        if peer["state"] != "online":
+            peer["state"] = "online"
+            online.add(user_id)
+            _online_view.invalidate()
+        _peers_view.invalidate()
+    return peer
+
+def expire_peers(now: float = None) -> list:
+    """Mark peers stale after PEER_STALE_AFTER and evict them after PEER_TIMEOUT.
+
+    Only entries that have come due are looked at; a peer heard from since
+    its entry was pushed is simply rescheduled. Returns evicted user_ids.
+    """
+    now = time.time() if now is None else now
+    gone = []
+    with peers_lock:
+        while _liveness and _liveness[0][0] <= now:
+            _, uid = heapq.heappop(_liveness)
+            _scheduled.discard(uid)
+            peer = peers.get(uid)
+            if peer is None:
+                continue  # Left or evicted already
+            idle = now - peer["last_seen"]
+            if idle >= config.PEER_TIMEOUT:
+                _evict_peer(uid)
+                gone.append(uid)
+            elif idle >= config.PEER_STALE_AFTER:
+                if peer["state"] == "online":
+                    peer["state"] = "stale"
+                    online.discard(uid)
+                    _online_view.invalidate()
+                    _peers_view.invalidate()
+                _schedule(uid, peer["last_seen"] + config.PEER_TIMEOUT)
+            else:
+                _schedule(uid, peer["last_seen"] + config.PEER_STALE_AFTER)
+    if gone:
+        _count_evicted("peers", len(gone))
+    return gone
+
+def peer_state(user_id: str):
+    """"online", "stale", or None for a peer we don't know (or have evicted)."""
+    peer = peers.get(user_id)
+    return peer["state"] if peer is not None else None
+
+def peer_address(user_id: str):
+    """The IP a peer's datagrams last came from, or None."""
+    peer = peers.get(user_id)
+    return peer["addr"] if peer is not None else None
+
+def peers_at(ip: str) -> int:
+    """How many known peers were last heard from ip."""
+    return len(addr_peers.get(ip, ()))
+
+def update_peer(user_id: str, display_name: str, status: str, capabilities: set, profile_rev: str = None) -> bool:
+    """Record a PROFILE. Returns True if the peer is new or changed its status."""
+    with peers_lock:
+        peer = peers.get(user_id) or _new_peer(user_id, time.time())
+        changed = not peer.get("profiled") or peer["status"] != status
+        peer.update(display_name=display_name, status=status, capabilities=capabilities,
+                    profile_rev=profile_rev, profiled=True)
+        _peers_view.invalidate()
+        _persist("peers", user_id, dict(peer, capabilities=sorted(capabilities)))
+    return changed
+
+def remove_peer(user_id: str):
+    """Forget a peer that left. Returns its record, or None."""
+    with peers_lock:
+        return _evict_peer(user_id)
+
+def _dm_key(dm: dict) -> str:
+    return f"{dm.get('received', 0):.6f}|{dm.get('from')}"
+
+def add_dm(dm: dict):
+    with dms_lock:
+        if len(dms) == dms.maxlen:
+            _unpersist("dms", _dm_key(dms[0]))  # The append below pushes it out
+            _count_evicted("dms")
+        dms.append(dm)
+        _dms_view.invalidate()
+    _persist("dms", _dm_key(dm), dm)
+
+def add_follower(user_id: str):
+    with followers_lock:
+        followers.add(user_id)
+        _followers_view.invalidate()
+    _persist("followers", user_id, True)
+
+def remove_follower(user_id: str) -> bool:
+    with followers_lock:
+        if user_id not in followers:
+            return False
+        followers.remove(user_id)
+        _followers_view.invalidate()
+    _unpersist("followers", user_id)
+    return True
+
+def set_group(group_id: str, group: dict):
+    with groups_lock:
+        groups[group_id] = group
+        _groups_view.invalidate()
+    _persist("groups", group_id, group)
+
+def update_group_members(group_id: str, add=(), remove=()):
+    """Apply a GROUP_UPDATE; returns the group, or None if we don't know it."""
+    with groups_lock:
+        group = groups.get(group_id)
+        if group is None:
+            return None
+        group["members"].extend(m for m in add if m not in group["members"])
+        for r in remove:
+            if r in group["members"]:
+                group["members"].remove(r)
+        _groups_view.invalidate()
+        _persist("groups", group_id, group)
+    return dict(group, members=tuple(group["members"]))
+
+def open_store(path: str, flush_interval: float) -> dict:
+    """Load persisted state into memory, then start writing changes behind it.
+
+    Returns how many entries each collection restored.
+    """
+    global store
+    from persistence import WriteBehindStore
+    loaded = WriteBehindStore(path, flush_interval)
+    counts = {}
+    with peers_lock:
+        rows = loaded.load("peers")
+        now = time.time()
+        for uid, peer in rows:
+            peer["capabilities"] = set(peer.get("capabilities", ()))
+            peer.setdefault("last_seen", now)
+            peers[uid] = peer
+            _set_addr(uid, peer, peer.get("addr"))
+            # Until it's heard from again, a restored peer counts as stale
+            peer["state"] = "stale"
+            _schedule(uid, peer["last_seen"] + config.PEER_TIMEOUT)
+        counts["peers"] = len(rows)
+
+    with posts_lock:
+        rows = loaded.load("posts")[-config.MAX_POSTS:]
+        for _, post in rows:
+            posts.append(post)
+            post_index[_post_key(post["user_id"], post["timestamp"])] = post
+        counts["posts"] = len(rows)
+
+    with dms_lock:
+        rows = loaded.load("dms")
+        dms.extend(dm for _, dm in rows)
+        counts["dms"] = len(rows)
+
+    with followers_lock:
+        rows = loaded.load("followers")
+        followers.update(uid for uid, _ in rows)
+        counts["followers"] = len(rows)
+
+    with groups_lock:
+        rows = loaded.load("groups")
+        groups.update(rows)
+        counts["groups"] = len(rows)
+
+    for view in (_peers_view, _online_view, _posts_view, _dms_view, _followers_view, _groups_view):
+        view.invalidate()
+    store = loaded
+    store.start()
+    return counts
+
+def close_store():
+    """Flush pending writes; called on exit."""
+    if store is not None:
+        store.close()
+
+def _approx_bytes(items) -> int:
+    # Shallow sizes of each record and its values; good enough for sizing limits
+    total = 0
+    for item in items:
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            total += sum(sys.getsizeof(v) for v in item.values())
+    return total
+
+def stats() -> dict:
+    """Entry counts, approximate bytes held and eviction totals per collection."""
+    usage = {}
+    with posts_lock:
+        usage["posts"] = (len(posts), _approx_bytes(posts) + sys.getsizeof(post_index))
+        usage["post_likes"] = (len(post_likes), sys.getsizeof(post_likes) + _approx_bytes(post_likes.values()))
+        usage["likes"] = (len(likes), _approx_bytes(likes))
+    with dms_lock:
+        usage["dms"] = (len(dms), _approx_bytes(dms))
+    with peers_lock:
+        usage["peers"] = (len(peers), _approx_bytes(peers.values()))
+    with _evicted_lock:
+        usage["evicted"] = dict(evicted)
+    return usage
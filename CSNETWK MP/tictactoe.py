@@ -3,13 +3,16 @@ import time
 import random
 from config import USER_ID, TTL_DEFAULT
 from parser import build_message
-from network import send_broadcast
+from network import send_to
 from logger import log, print_non_verbose
-from storage import storage_lock
+from storage import ShardedLock, peer_state
+from dispatch import register
+from timers import call_later
 
 # Game storage
 games = {}  # {game_id: GameState}
-game_lock = storage_lock
+game_locks = ShardedLock()  # Per game_id; independent of storage's locks
+GAME_TIMEOUT = 300  # Seconds without a move before the player to move forfeits
 
 class GameState:
     def __init__(self, game_id, player1, player2, first_player):
@@ -23,6 +26,7 @@ class GameState:
         self.result = None
         self.winning_line = None
         self.accepted = False  # Track if game has been accepted by invitee
+        self.last_move = time.time()
         
     def make_move(self, player, position, symbol):
         """Make a move and return if successful"""
@@ -37,6 +41,7 @@ class GameState:
             
         self.board[position] = symbol
         self.turn_number += 1
+        self.last_move = time.time()
         
         # Check for win/draw
         winner = self.check_winner()
@@ -113,15 +118,42 @@ def print_game_result(game):
     elif game.result == "FORFEIT":
         print_non_verbose("Game forfeited!")
 
+def _watch_game(game_id: str, game: GameState):
+    """Timer: forfeit a game that has gone GAME_TIMEOUT seconds without a move."""
+    with game_locks.for_key(game_id):
+        if games.get(game_id) is not game or game.game_over:
+            return
+        idle = time.time() - game.last_move
+        if idle < GAME_TIMEOUT:
+            call_later(GAME_TIMEOUT - idle, _watch_game, game_id, game)
+            return
+        game.game_over = True
+        game.result = "FORFEIT"
+        opponent = game.player2 if USER_ID == game.player1 else game.player1
+        our_turn = game.current_turn == USER_ID
+
+    if our_turn:
+        print_non_verbose(f"Game {game_id} timed out waiting for your move. You forfeit.")
+    else:
+        print_non_verbose(f"Game {game_id} timed out. {get_display_name(opponent)} forfeits.")
+    send_tictactoe_result(game_id, opponent)
+    with game_locks.for_key(game_id):
+        if games.get(game_id) is game:
+            del games[game_id]
+
 def send_tictactoe_invite(target_user: str):
     """Send a TicTacToe game invitation"""
+    if peer_state(target_user) != "online":
+        print_non_verbose(f"{target_user} is not online")
+        return
     try:
         # Generate game ID (g + number 0-255)
         game_id = f"g{random.randint(0, 255)}"
         
         # Create game state - INVITEE goes first (to accept by playing)
-        with game_lock:
-            games[game_id] = GameState(game_id, USER_ID, target_user, target_user)
+        with game_locks.for_key(game_id):
+            game = games[game_id] = GameState(game_id, USER_ID, target_user, target_user)
+        call_later(GAME_TIMEOUT, _watch_game, game_id, game)
         
         timestamp = int(time.time())
         message_id = hex(random.getrandbits(64))[2:]
@@ -138,7 +170,7 @@ def send_tictactoe_invite(target_user: str):
             "TOKEN": token
         })
         
-        send_broadcast(invite_msg)
+        send_to(target_user, invite_msg)
         log(f"TicTacToe invite sent to {target_user} for game {game_id}")
         
     except Exception as e:
@@ -147,7 +179,7 @@ def send_tictactoe_invite(target_user: str):
 def send_tictactoe_move(game_id: str, position: int):
     """Send a TicTacToe move"""
     try:
-        with game_lock:
+        with game_locks.for_key(game_id):
             if game_id not in games:
                 print_non_verbose("Game not found")
                 return
@@ -207,7 +239,7 @@ def send_tictactoe_move(game_id: str, position: int):
             "TOKEN": token
         })
         
-        send_broadcast(move_msg)
+        send_to(opponent, move_msg)
         
         
         if game.game_over:
@@ -221,13 +253,14 @@ def send_tictactoe_move(game_id: str, position: int):
 def send_tictactoe_result(game_id: str, opponent: str):
     """Send game result message"""
     try:
-        with game_lock:
+        with game_locks.for_key(game_id):
             if game_id not in games:
                 return
             game = games[game_id]
         
         timestamp = int(time.time())
         message_id = hex(random.getrandbits(64))[2:]
+        token = f"{USER_ID}|{timestamp + TTL_DEFAULT}|game"
         
         our_symbol = 'X' if USER_ID == game.player1 else 'O'
         
@@ -240,23 +273,26 @@ def send_tictactoe_result(game_id: str, opponent: str):
             "RESULT": game.result,
             "SYMBOL": our_symbol,
             "WINNING_LINE": ",".join(map(str, game.winning_line)) if game.winning_line else "",
-            "TIMESTAMP": timestamp
+            "TIMESTAMP": timestamp,
+            "TOKEN": token
         })
         
-        send_broadcast(result_msg)
+        send_to(opponent, result_msg)
         log(f"TicTacToe result sent for game {game_id}: {game.result}")
         
     except Exception as e:
         log(f"Error sending TicTacToe result: {e}")
 
+@register("TICTACTOE_INVITE")
 def handle_tictactoe_invite(msg, sender_id):
     """Handle incoming TicTacToe invitation"""
     try:
         game_id = msg.get("GAMEID")
         
         
-        with game_lock:
-            games[game_id] = GameState(game_id, sender_id, USER_ID, USER_ID)
+        with game_locks.for_key(game_id):
+            game = games[game_id] = GameState(game_id, sender_id, USER_ID, USER_ID)
+        call_later(GAME_TIMEOUT, _watch_game, game_id, game)
         
         sender_name = get_display_name(sender_id)
         print_non_verbose(f"{sender_name} is inviting you to play tic-tac-toe.")
@@ -266,6 +302,7 @@ def handle_tictactoe_invite(msg, sender_id):
     except Exception as e:
         log(f"Error handling TicTacToe invite: {e}")
 
+@register("TICTACTOE_MOVE")
 def handle_tictactoe_move(msg, sender_id):
     """Handle incoming TicTacToe move"""
     try:
@@ -274,7 +311,7 @@ def handle_tictactoe_move(msg, sender_id):
         symbol = msg.get("SYMBOL")
         turn = int(msg.get("TURN", 0))
         
-        with game_lock:
+        with game_locks.for_key(game_id):
             if game_id not in games:
                 log(f"Unknown game: {game_id}")
                 return
@@ -299,6 +336,7 @@ def handle_tictactoe_move(msg, sender_id):
     except Exception as e:
         log(f"Error handling TicTacToe move: {e}")
 
+@register("TICTACTOE_RESULT")
 def handle_tictactoe_result(msg, sender_id):
     """Handle incoming TicTacToe result"""
     try:
@@ -306,9 +344,12 @@ def handle_tictactoe_result(msg, sender_id):
         result = msg.get("RESULT")
         winning_line = msg.get("WINNING_LINE", "")
         
-        with game_lock:
+        with game_locks.for_key(game_id):
             if game_id in games:
                 game = games[game_id]
+                if result == "FORFEIT":
+                    game.game_over = True
+                    game.result = result
                 # Print final board state
                 game.print_board()
                 print_game_result(game)
@@ -322,14 +363,15 @@ def handle_tictactoe_result(msg, sender_id):
 
 def list_active_games():
     """List all active games"""
-    with game_lock:
-        if not games:
-            print_non_verbose("No active games")
-            return
-        
-        print_non_verbose("Active TicTacToe games:")
-        for game_id, game in games.items():
+    snapshot = list(games.items())
+    if not snapshot:
+        print_non_verbose("No active games")
+        return
+
+    print_non_verbose("Active TicTacToe games:")
+    for game_id, game in snapshot:
+        with game_locks.for_key(game_id):
             player1_name = get_display_name(game.player1)
             player2_name = get_display_name(game.player2)
             current_name = get_display_name(game.current_turn)
-            print_non_verbose(f"  {game_id}: {player1_name} (X) vs {player2_name} (O) - {current_name}'s turn")
\ No newline at end of file
+        print_non_verbose(f"  {game_id}: {player1_name} (X) vs {player2_name} (O) - {current_name}'s turn")
\ No newline at end of file
@@ -0,0 +1,93 @@
+# timers.py
+import time
+import heapq
+import itertools
+import threading
+from logger import log
+
+class Timer:
+    """Handle for one scheduled callback; cancel() is O(1)."""
+
+    __slots__ = ("when", "fn", "args", "interval", "cancelled")
+
+    def __init__(self, when, fn, args, interval=None):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True  # Dropped when it reaches the top of the heap
+
+class TimerScheduler:
+    """One heap of timers for every module, driven by a single thread or the asyncio loop.
+
+    Modules register timeouts with call_later/call_every instead of running
+    their own sleep loops. Scheduling is O(log n), cancelling is O(1), and
+    firing costs nothing for timers that aren't due. Callbacks run on the
+    driver, so they should be short; a call_every callback may return a
+    number to set its own next delay.
+    """
+
+    def __init__(self):
+        self.waker = None  # Called when an earlier timer is added (set by the asyncio driver)
+        self._heap = []
+        self._seq = itertools.count()  # Tie-breaker so equal times never compare Timers
+        self._pending = False
+        self._cond = threading.Condition()
+
+    def _push(self, timer: Timer):
+        with self._cond:
+            heapq.heappush(self._heap, (timer.when, next(self._seq), timer))
+            earliest = self._heap[0][2] is timer
+            if earliest:
+                self._pending = True
+                self._cond.notify()
+        if earliest and self.waker is not None:
+            self.waker()
+        return timer
+
+    def call_later(self, delay: float, fn, *args) -> Timer:
+        """Run fn(*args) once, delay seconds from now."""
+        return self._push(Timer(time.monotonic() + delay, fn, args))
+
+    def call_every(self, interval: float, fn, *args, first: float = 0.0) -> Timer:
+        """Run fn(*args) after first seconds, then every interval (or whatever fn returns)."""
+        return self._push(Timer(time.monotonic() + first, fn, args, interval))
+
+    def poll(self):
+        """Run every due timer. Returns seconds until the next one, or None if none are set."""
+        while True:
+            with self._cond:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    return None
+                when, _, timer = self._heap[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    return delay
+                heapq.heappop(self._heap)
+
+            try:
+                result = timer.fn(*timer.args)
+            except Exception as e:
+                log(f"Timer {getattr(timer.fn, '__name__', timer.fn)} failed: {e}")
+                result = None
+            if timer.interval is not None and not timer.cancelled:
+                timer.when = time.monotonic() + (result if isinstance(result, (int, float)) else timer.interval)
+                self._push(timer)
+
+    def run(self):
+        """Thread driver: fire timers forever, sleeping until the next is due."""
+        while True:
+            delay = self.poll()
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait(delay)
+                self._pending = False
+
+timers = TimerScheduler()  # Shared by every module
+call_later = timers.call_later
+call_every = timers.call_every
@@ -0,0 +1,109 @@
+# tokens.py
+import time
+import threading
+import config
+from logger import log
+from dispatch import register
+
+# Scope a TOKEN must carry for each message TYPE; types not listed need no token
+SCOPES = {
+    "POST": "broadcast",
+    "LIKE": "broadcast",
+    "DM": "chat",
+    "FOLLOW": "follow",
+    "UNFOLLOW": "follow",
+    "FILE_OFFER": "file",
+    "FILE_CHUNK": "file",
+    "FILE_ACCEPT": "file",
+    "FILE_REJECT": "file",
+    "FILE_ACK": "file",
+    "FILE_NACK": "file",
+    "FILE_RECEIVED": "file",
+    "GROUP_CREATE": "group",
+    "GROUP_UPDATE": "group",
+    "GROUP_MESSAGE": "group",
+    "TICTACTOE_INVITE": "game",
+    "TICTACTOE_MOVE": "game",
+    "TICTACTOE_RESULT": "game",
+}
+_SCOPES = {t.encode(): s.encode() for t, s in SCOPES.items()}
+
+# Older peers send TICTACTOE_RESULT without a token
+TOKEN_OPTIONAL = {b"TICTACTOE_RESULT"}
+
+_valid = {}    # {token: (user, scope, expiry)} for tokens that parsed and weren't revoked
+_revoked = {}  # {token: expiry}; kept until the token would have expired anyway
+_lock = threading.Lock()
+
+def _parse(token: bytes):
+    parts = token.split(b"|")
+    if len(parts) != 3:
+        return None
+    try:
+        return parts[0], parts[2], int(parts[1])
+    except ValueError:
+        return None
+
+def _purge(now: float):
+    # Caller holds _lock
+    for token in [t for t, entry in _valid.items() if entry[2] <= now]:
+        del _valid[token]
+    for token in [t for t, expiry in _revoked.items() if expiry <= now]:
+        del _revoked[token]
+
+def check(token, msg_type: bytes, sender: bytes):
+    """Why a message's token is unacceptable, or None if it may be handled.
+
+    token, msg_type and sender are the raw bytes peeked from the datagram.
+    A token is parsed once and memoized until it expires, so the hundreds of
+    FILE_CHUNKs of a transfer cost one dict lookup each.
+    """
+    scope = _SCOPES.get(msg_type)
+    if scope is None:
+        return None
+    if token is None:
+        return None if msg_type in TOKEN_OPTIONAL else "missing token"
+
+    now = time.time()
+    entry = _valid.get(token)
+    if entry is None:
+        entry = _parse(token)
+        if entry is None:
+            return "malformed token"
+        with _lock:
+            if token in _revoked:
+                return "revoked token"
+            if len(_valid) >= config.TOKEN_CACHE_SIZE:
+                _purge(now)
+                if len(_valid) >= config.TOKEN_CACHE_SIZE:
+                    _valid.clear()  # Everything left is live; start over rather than grow
+            _valid[token] = entry
+
+    user, token_scope, expiry = entry
+    if expiry <= now:
+        return "expired token"
+    if token_scope != scope:
+        return f"token scope {token_scope.decode('utf-8', errors='ignore')} not valid for {msg_type.decode()}"
+    if user != sender:
+        return "token issued to another user"
+    return None
+
+def revoke(token: bytes, sender: bytes) -> bool:
+    """Honor a REVOKE; only the user a token was issued to may revoke it."""
+    entry = _parse(token)
+    if entry is None or entry[0] != sender:
+        return False
+    with _lock:
+        _valid.pop(token, None)
+        _revoked[token] = entry[2]
+        if len(_revoked) > config.TOKEN_CACHE_SIZE:
+            _purge(time.time())
+    return True
+
+@register("REVOKE")
+def handle_revoke(msg, sender_id):
+    token = msg.get("TOKEN", "")
+    if revoke(token.encode("utf-8"), (sender_id or "").encode("utf-8")):
+        log(f"Token revoked by {sender_id}")
+    else:
+        log(f"Ignoring REVOKE from {sender_id} for a token it doesn't own")